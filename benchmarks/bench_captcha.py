@@ -0,0 +1,85 @@
+"""
+Benchmark the captcha OCR backends against the labelled captcha
+fixtures (test/fixtures/captcha/<answer>.png).
+
+The fixtures aren't checked in. Collect them by crawling with a
+Captcha that archives the captchas the server accepts, so every file
+is named after its right answer:
+
+    ecourt.captcha = Captcha(archive="test/fixtures/captcha", archive_limit=200)
+
+    python benchmarks/bench_captcha.py [--backend subprocess] [--backend tesserocr] [--workers N]
+
+With --workers, the batch is also solved through a CaptchaSolverPool
+to measure multi-process throughput.
+"""
+import glob
+import os
+import sys
+import time
+import click
+import cv2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ecourts"))
+
+from captcha import Captcha, CaptchaError, CaptchaSolverPool, ocr_backend
+
+
+def run(captcha: Captcha, files: list[str]) -> tuple[float, int]:
+    correct = 0
+    start = time.perf_counter()
+    for file in files:
+        try:
+            if captcha.decaptcha(file) == os.path.basename(file)[:-4]:
+                correct += 1
+        except CaptchaError:
+            pass
+    return time.perf_counter() - start, correct
+
+
+def run_pool(name: str, workers: int, files: list[str]) -> tuple[float, int]:
+    images = []
+    for file in files:
+        with open(file, "rb") as f:
+            images.append(f.read())
+    with CaptchaSolverPool(workers=workers, ocr=name) as pool:
+        # Warm up the workers, so process start up is not measured
+        pool.solve_many(images[:workers])
+        start = time.perf_counter()
+        results = pool.solve_many(images)
+        elapsed = time.perf_counter() - start
+    correct = sum(r == os.path.basename(f)[:-4] for (r, _), f in zip(results, files))
+    return elapsed, correct
+
+
+def report(label: str, files: list[str], elapsed: float, correct: int):
+    click.echo(
+        f"{label}: {len(files) / elapsed:.1f} solves/s, "
+        f"accuracy {correct}/{len(files)} ({100 * correct / len(files):.1f}%)"
+    )
+
+
+@click.command()
+@click.option("--backend", "backends", multiple=True, default=["subprocess", "tesserocr"])
+@click.option("--fixtures", default="test/fixtures/captcha/*.png")
+@click.option("--workers", type=int, default=0, help="Also benchmark a CaptchaSolverPool")
+def benchmark(backends, fixtures, workers):
+    files = sorted(glob.glob(fixtures))
+    if not files:
+        raise click.ClickException(
+            f"No captcha fixtures matched {fixtures}, see the docstring of {__file__} to collect them"
+        )
+
+    for name in backends:
+        try:
+            captcha = Captcha(ocr=ocr_backend(name))
+        except ImportError as e:
+            click.echo(f"{name}: unavailable ({e})")
+            continue
+        report(name, files, *run(captcha, files))
+        if workers:
+            report(f"{name} x{workers} processes", files, *run_pool(name, workers, files))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,59 @@
+"""
+Benchmark the CaseDetails parser backends over the case history
+fixtures (test/fixtures/case_details/*.html), checking every parsed
+case against its YAML fixture.
+
+    python benchmarks/bench_case_details.py [--backend html5lib] [--backend lxml] [--rounds 20] [--html]
+"""
+import glob
+import os
+import sys
+import time
+import click
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ecourts"))
+
+from parsers.case_details import CaseDetails
+
+
+def load(fixtures: str) -> list[tuple[str, str, object]]:
+    pages = []
+    for file in sorted(glob.glob(fixtures)):
+        with open(file) as f:
+            html = f.read()
+        with open(os.path.splitext(file)[0] + ".yml") as f:
+            pages.append((file, html, yaml.unsafe_load(f)))
+    return pages
+
+
+@click.command()
+@click.option("--backend", "backends", multiple=True, default=CaseDetails.BACKENDS)
+@click.option("--fixtures", default="test/fixtures/case_details/*.html")
+@click.option("--rounds", type=int, default=20, help="Times to parse every page")
+@click.option("--html", "with_html", is_flag=True, help="Also build the cleaned .html of every page")
+def benchmark(backends, fixtures, rounds, with_html):
+    pages = load(fixtures)
+    if not pages:
+        raise click.ClickException(f"No case details fixtures matched {fixtures}")
+
+    for backend in backends:
+        try:
+            for file, html, expected in pages:
+                if CaseDetails(html, backend=backend).case != expected:
+                    raise click.ClickException(f"{backend}: {file} does not match its fixture")
+        except ImportError as e:
+            click.echo(f"{backend}: unavailable ({e})")
+            continue
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for _, html, _ in pages:
+                parsed = CaseDetails(html, backend=backend, keep_html=with_html)
+                if with_html:
+                    parsed.html
+        elapsed = time.perf_counter() - start
+        click.echo(f"{backend}: {rounds * len(pages) / elapsed:.1f} pages/s")
+
+
+if __name__ == "__main__":
+    benchmark()
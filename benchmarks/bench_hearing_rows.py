@@ -0,0 +1,59 @@
+"""
+Micro-benchmark of the per row parsing hot path: extracting the hearings
+from already walked case history pages (test/fixtures/case_details/*.html),
+and parse_date over the dates found in them.
+
+    python benchmarks/bench_hearing_rows.py [--rounds 200]
+"""
+import glob
+import os
+import sys
+import time
+import click
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ecourts"))
+
+from parsers.case_details import CaseDetails
+from parsers.utils import parse_date
+
+
+@click.command()
+@click.option("--fixtures", default="test/fixtures/case_details/*.html")
+@click.option("--rounds", type=int, default=200, help="Times to extract every page")
+def benchmark(fixtures, rounds):
+    parser = CaseDetails.__new__(CaseDetails)
+    pages = []
+    for file in sorted(glob.glob(fixtures)):
+        with open(file) as f:
+            pages.append(parser.walk(BeautifulSoup(f.read(), "html5lib")))
+    if not pages:
+        raise click.ClickException(f"No case details fixtures matched {fixtures}")
+
+    hearings = [h for sections in pages for h in parser.extract_hearing(sections)]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for sections in pages:
+            parser.extract_hearing(sections)
+    elapsed = time.perf_counter() - start
+    click.echo(f"extract_hearing: {elapsed / (rounds * len(hearings)) * 1e6:.1f} µs/row ({len(hearings)} rows)")
+
+    dates = [d.strftime(fmt) for h in hearings for d in [h.date] if d for fmt in ["%d-%m-%Y", "%Y%m%d"]]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for d in dates:
+            parse_date(d)
+    elapsed = time.perf_counter() - start
+    click.echo(f"parse_date: {elapsed / (rounds * len(dates)) * 1e6:.2f} µs/call ({len(dates)} dates)")
+
+    if hasattr(parse_date, "__wrapped__"):
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for d in dates:
+                parse_date.__wrapped__(d)
+        elapsed = time.perf_counter() - start
+        click.echo(f"parse_date, uncached: {elapsed / (rounds * len(dates)) * 1e6:.2f} µs/call")
+
+
+if __name__ == "__main__":
+    benchmark()
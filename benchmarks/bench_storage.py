@@ -0,0 +1,84 @@
+"""
+Benchmark Storage.addCases against the previous row by row
+SELECT + UPDATE/INSERT loop, inserting and then re-upserting
+synthetic cases. By default these are modelled on case type search
+results (test/fixtures/cases), use --fixtures to try fully expanded
+cases instead.
+
+    python benchmarks/bench_storage.py [--rows 10000] [--rows 100000]
+        [--fixtures "test/fixtures/case_details/*.yml"]
+"""
+import copy
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+import click
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "ecourts"))
+
+from entities import Court
+from storage import Storage
+
+
+def legacy_add_cases(storage: Storage, court: Court, cases, extra_fields: dict = {}):
+    cursor = storage.conn.cursor()
+    for case in cases:
+        search_result = cursor.execute(
+            "SELECT value FROM cases WHERE cnr_number = ?", (case.cnr_number,)
+        ).fetchone()
+        if search_result:
+            existing_row = json.loads(search_result[0])
+            patch = {}
+            for k in ['status', 'year', 'act_type', 'case_type']:
+                patch[k] = extra_fields.get(k, existing_row.get(k))
+            d = json.dumps(case.json() | patch, default=str)
+            storage.conn.execute("UPDATE cases SET value = ? WHERE cnr_number = ?", (d, case.cnr_number))
+        else:
+            d = json.dumps(case.json() | extra_fields, default=str)
+            cursor.execute(
+                "INSERT INTO cases (state_code, court_code, value) VALUES (?, ?, ?)", (court.state_code, court.court_code or "1", d)
+            )
+    cursor.close()
+    storage.conn.commit()
+
+
+def synthetic_cases(n: int, fixtures: str) -> list:
+    templates = [yaml.unsafe_load(open(f)) for f in sorted(glob.glob(fixtures))]
+    cases = []
+    for i in range(n):
+        case = copy.copy(templates[i % len(templates)])
+        case.cnr_number = f"BENC{i:08d}2024"
+        case.registration_number = f"{i}/2024"
+        cases.append(case)
+    return cases
+
+
+def timed(fn, *args) -> float:
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--rows", multiple=True, type=int, default=[10_000, 100_000])
+@click.option("--fixtures", default="test/fixtures/cases/*.yml")
+def benchmark(rows, fixtures):
+    court = Court(state_code="1")
+    extra = {"status": "Pending", "year": 2024}
+    for n in rows:
+        cases = synthetic_cases(n, fixtures)
+        for name, add in [("row by row", legacy_add_cases), ("batched upsert", Storage.addCases)]:
+            with tempfile.TemporaryDirectory() as d:
+                storage = Storage(os.path.join(d, "ecourts.db"))
+                insert = timed(add, storage, court, cases, extra)
+                update = timed(add, storage, court, cases, {"act_type": "101"})
+                storage.close()
+            click.echo(f"{n} rows, {name}: insert {n / insert:,.0f} rows/s, update {n / update:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from collections.abc import Iterator
+from typing import Optional
+from entities import Court
+
+
+class ResponseArchive:
+    """
+    An append-only archive of the raw responses returned by apimethod.
+
+    Every response body is stored once, zstd compressed, under
+    objects/ by its sha256. index.jsonl has one line per response with
+    the endpoint, the request parameters (without captcha and csrf
+    token), the court and when it was fetched, in fetch order.
+
+    Needs zstandard, which is part of the archive extra.
+    """
+
+    INDEX = "index.jsonl"
+    # Request parameters that are specific to the session, and not kept
+    SESSION_PARAMS = ["captcha", "__csrf_magic"]
+
+    def __init__(self, directory: str, level: int = 10):
+        self.directory = directory
+        self.level = level
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+
+    def _object(self, digest: str) -> str:
+        return os.path.join(self.directory, "objects", digest[:2], digest[2:] + ".zst")
+
+    def add(self, path: str, params: dict, court: Court, content: str) -> str:
+        import zstandard
+
+        body = content.encode()
+        digest = hashlib.sha256(body).hexdigest()
+        filename = self._object(digest)
+        if not os.path.exists(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                f.write(zstandard.ZstdCompressor(level=self.level).compress(body))
+            os.replace(tmp, filename)
+        entry = {
+            "digest": digest,
+            "path": path,
+            "params": {k: v for k, v in params.items() if k not in self.SESSION_PARAMS},
+            "state_code": court.state_code,
+            "court_code": court.court_code or "1",
+            "fetched_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        }
+        with self.lock, open(os.path.join(self.directory, self.INDEX), "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+        return digest
+
+    def read(self, digest: str) -> str:
+        import zstandard
+
+        with open(self._object(digest), "rb") as f:
+            return zstandard.ZstdDecompressor().decompress(f.read()).decode()
+
+    def entries(self) -> Iterator[dict]:
+        try:
+            with open(os.path.join(self.directory, self.INDEX)) as f:
+                for line in f:
+                    yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+
+def parse_entry(directory: str, entry: dict) -> Optional[tuple]:
+    """
+    Parse an archived response, returning (kind, court, extra_fields, items)
+    or None for endpoints that aren't replayed
+    """
+    from parsers.cases import parse_cases
+    from parsers.orders import parse_orders
+    from parsers.cause_lists import parse_cause_lists
+    from parsers.case_details import CaseDetails
+
+    path, params = entry["path"], entry["params"]
+    court = Court(state_code=entry["state_code"], court_code=entry["court_code"])
+    action = params.get("action_code")
+    html = ResponseArchive(directory).read(entry["digest"])
+
+    if path == "/cases/o_civil_case_history.php":
+        case = CaseDetails(html, keep_html=False).case
+        if params.get("case_no"):
+            case.case_number = params["case_no"]
+        return ("cases", court, {}, [case])
+    if action == "showRecords" and path in ["/cases/s_casetype_qry.php", "/cases/s_actwise_qry.php", "/cases/case_no_qry.php"]:
+        extra_fields = {}
+        # The same extra fields as get-cases --save
+        if path == "/cases/s_casetype_qry.php":
+            case_type = params.get("case_type")
+            extra_fields = {"status": params.get("f"), "case_type_int": int(case_type) if case_type else None}
+        elif path == "/cases/s_actwise_qry.php":
+            extra_fields = {"status": params.get("f"), "act_type": params.get("actcode")}
+        return ("cases", court, extra_fields, list(parse_cases(html)))
+    if path == "/cases/s_orderdate_qry.php":
+        return ("orders", court, {}, list(parse_orders(html)))
+    if path == "/cases/highcourt_causelist_qry.php":
+        return ("cause_lists", court, {}, list(parse_cause_lists(html)))
+    return None
+
+
+def _parse_entry(args):
+    directory, entry = args
+    try:
+        return parse_entry(directory, entry)
+    except Exception as e:
+        return ("errors", None, {}, [f"{entry['digest']} {entry['path']}: {e!r}"])
+
+
+def reparse(archive: ResponseArchive, storage, workers: Optional[int] = None) -> dict[str, int]:
+    """
+    Replay every archived response through the parsers, in parallel
+    across workers processes, and write the cases to storage in the
+    order they were fetched, so that later case details win over
+    earlier search results. No requests are made.
+
+    Orders and cause lists are parsed and counted, Storage does not
+    keep them. Returns counts per kind, including parse "errors".
+    """
+    counts = {"cases": 0, "orders": 0, "cause_lists": 0, "errors": 0, "skipped": 0}
+    with ProcessPoolExecutor(workers) as executor:
+        jobs = ((archive.directory, entry) for entry in archive.entries())
+        for result in executor.map(_parse_entry, jobs, chunksize=16):
+            if result is None:
+                counts["skipped"] += 1
+                continue
+            kind, court, extra_fields, items = result
+            counts[kind] += len(items)
+            if kind == "errors":
+                print(f"Error parsing {items[0]}", file=sys.stderr)
+            if kind == "cases" and items:
+                storage.addCases(court, items, {k: v for k, v in extra_fields.items() if v != None})
+    return counts
+
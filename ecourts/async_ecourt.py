@@ -0,0 +1,304 @@
+import asyncio
+import datetime
+import weakref
+from collections.abc import Iterator
+from urllib.parse import urlparse
+from captcha import Captcha, CaptchaError
+from csrf import CSRFToken, CSRFError
+from retry import RetryPolicy
+from collections import deque
+from ecourt import ApiCall, ECourt, RetryException
+from entities import Court, CaseType, Case, Order, ActType, CauseList
+from parsers.orders import parse_orders
+from parsers.options import parse_options
+from parsers.cases import parse_cases
+from parsers.cause_lists import parse_cause_lists
+
+
+class HostLimiter:
+    """
+    Caps the number of in-flight requests against a single host.
+
+    One limiter is shared by every AsyncECourt unless another one is
+    passed in, so sweeping all courts concurrently still respects the
+    limit against hcservices.ecourts.gov.in.
+    """
+
+    def __init__(self, limit: int = 8):
+        self.limit = limit
+        # Semaphores are bound to the event loop they are first used in
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def set_limit(self, limit: int):
+        self.limit = limit
+        self._semaphores.clear()
+
+    def __call__(self, url: str) -> asyncio.Semaphore:
+        host = urlparse(url).netloc
+        per_loop = self._semaphores.setdefault(asyncio.get_running_loop(), {})
+        if host not in per_loop:
+            per_loop[host] = asyncio.Semaphore(self.limit)
+        return per_loop[host]
+
+
+class AsyncECourt:
+    """
+    An asyncio version of ECourt, built on httpx.
+
+    Every instance keeps its own cookie jar (and hence server session),
+    while requests across all instances are throttled per host by a
+    shared HostLimiter, and by the same rate limiter as ECourt.
+    Captcha-gated calls are serialised per instance, since the server
+    only honours the last captcha issued to a session.
+
+    Use it as an async context manager, or call aclose() when done.
+    """
+
+    CSRF_MAGIC_PARAMS = ECourt.CSRF_MAGIC_PARAMS
+    BASE_URL = ECourt.BASE_URL
+    LIMITER = HostLimiter()
+
+    url = ECourt.url
+    search_page_url = ECourt.search_page_url
+    validate_response = ECourt.validate_response
+
+    def __init__(self, court: Court, client=None, limiter: HostLimiter = None, solver=None):
+        """
+        `solver` may be a CaptchaSolverPool shared between instances, in which
+        case captchas are solved in its worker processes instead of a thread.
+        """
+        import httpx
+
+        self.client = client or httpx.AsyncClient(timeout=httpx.Timeout(10, connect=5))
+        self.court = court
+        self.captcha = Captcha()
+        self.limiter = limiter or self.LIMITER
+        self.solver = solver
+        self.csrf = CSRFToken(url=self.search_page_url(), token=self.CSRF_MAGIC_PARAMS["__csrf_magic"])
+        self.max_attempts = 15
+        self.retry_policy = RetryPolicy()
+        self.call_log = deque(maxlen=ECourt.CALL_LOG_SIZE)
+        self.responses = None
+        self.pending_responses = {}
+        self._captcha_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    def set_response_store(self, storage):
+        self.responses = storage
+
+    def take_responses(self, cases: list[Case]) -> list[tuple[str, str, str]]:
+        return [r for case in cases if (r := self.pending_responses.pop(case.cnr_number, None))]
+
+    def set_retry_policy(self, policy: RetryPolicy):
+        self.retry_policy = policy
+
+    def set_max_attempts(self, attempts):
+        self.max_attempts = attempts
+
+    def attempts(self):
+        return self.max_attempts
+
+    async def request(self, method: str, url: str, **kwargs):
+        delay = ECourt.RATE_LIMITER.reserve(url)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self.limiter(url):
+            return await self.client.request(method, url, **kwargs)
+
+    async def refresh_csrf(self):
+        self.csrf.refreshes += 1
+        r = await self.request("GET", self.csrf.url)
+        if not self.csrf.update(r.text):
+            raise CSRFError(f"No {self.csrf.NAME} token found at {self.csrf.url}")
+
+    async def solve_captcha(self):
+        retry = self.captcha.retry
+        while retry > 0:
+            r = await self.request("GET", Captcha.URL, headers=Captcha.HEADERS)
+            if r.status_code != 200:
+                retry -= 1
+                continue
+            if self.solver:
+                result, confidence = await asyncio.wrap_future(self.solver.submit(r.content))
+                if result:
+                    # So that report() and confidence_stats() cover it
+                    return self.captcha.track(result, confidence, r.content)
+                if confidence is not None:
+                    self.captcha.low_confidence += 1
+                retry -= 1
+                continue
+            try:
+                return await asyncio.to_thread(self.captcha.decode, r.content)
+            except CaptchaError:
+                retry -= 1
+        raise CaptchaError("Couldn't solve captcha after retries")
+
+    def apimethod(path, court=False, csrf=True, action=None, captcha=False):
+        def decorator(func):
+            async def attempt(self, *args, **kwargs):
+                import httpx
+
+                call = ApiCall(self, path, court, csrf, action)
+                while True:
+                    try:
+                        call.add_csrf()
+                        extra_params = None if call.reuse_params else await func(self, *args, **kwargs)
+                        params = call.start(extra_params, kwargs)
+                        response = await self.request("POST", self.url(path), data=params)
+                        if call.csrf_rejected(response):
+                            await self.refresh_csrf()
+                            continue
+                        call.check(response)
+                        return call.finish(response)
+                    except ApiCall.ERRORS + (httpx.HTTPError,) as e:
+                        delay = call.failed(e, self.client)
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+
+            async def inner(self, *args, **kwargs):
+                if not captcha:
+                    return await attempt(self, *args, **kwargs)
+                async with self._captcha_lock:
+                    return await attempt(self, *args, **kwargs)
+
+            return inner
+
+        return decorator
+
+    @apimethod(
+        path="/cases/s_orderdate_qry.php", court=True, csrf=True, action="showRecords", captcha=True
+    )
+    async def _get_orders(self, *args, **kwargs):
+        return {
+            "captcha": await self.solve_captcha(),
+        }
+
+    async def downloadOrder(self, order: Order, court_case: Case, filename: str):
+        assert order.filename != None
+        assert court_case.case_type != None
+        assert court_case.registration_number != None
+        assert court_case.cnr_number != None
+        queryParams = {
+            "filename": order.filename,
+            "caseno": f"{court_case.case_type}/{court_case.registration_number}",
+            "cCode": self.court.court_code or "1",
+            "state_code": self.court.state_code,
+            "cino": court_case.cnr_number,
+        }
+        r = await self.request("GET", self.url("/cases/display_pdf.php", queryParams))
+        with open(filename, "wb") as f:
+            f.write(r.content)
+
+    @apimethod(
+        path="/cases/s_casetype_qry.php", action="showRecords", court=True, captcha=True
+    )
+    async def _search_cases_by_case_type(self, case_type, status, search_year, **kwargs):
+        assert status in ["Pending", "Disposed"]
+
+        r = {
+            "captcha": await self.solve_captcha(),
+            "f": status,
+            "case_type": str(case_type)
+        }
+        if search_year:
+            r["search_year"] = search_year
+        return r
+
+    async def CaseType(self, case_type: str, status: str, year: int = None):
+        r = await self.request("GET", self.search_page_url())
+        self.csrf.update(r.text)
+        result = await self._search_cases_by_case_type(case_type, status, year)
+        return parse_cases(result)
+
+    @apimethod(
+        path="/cases/s_actwise_qry.php", action="showRecords", court=True, csrf=True, captcha=True
+    )
+    async def _search_cases_by_act_type(self, act_type: str, status: str, **kwargs):
+        return {
+            "captcha": await self.solve_captcha(),
+            "actcode": act_type,
+            "f": status
+        }
+
+    async def ActType(self, act_type: str, status: str):
+        result = await self._search_cases_by_act_type(act_type, status)
+        return parse_cases(result)
+
+    @apimethod(path="/cases/o_civil_case_history.php", court=True, action=None, csrf=False)
+    async def getCaseHistory(self, case: Case, **kwargs):
+        return case.expandParams()
+
+    @apimethod(path="/cases/case_no_qry.php", action="showRecords", court=True, captcha=True)
+    async def searchSingleCase(self, registration_number: str, case_type: str):
+        return {
+            "captcha": await self.solve_captcha(),
+            "case_type": case_type,
+            "case_no": registration_number.split("/")[0],
+            "rgyear": registration_number.split("/")[1],
+            "caseNoType": "new",
+            "displayOldCaseNo": "NO"
+        }
+
+    async def expand_case(self, case: Case):
+        from parsers.case_details import CaseDetails
+        endpoint = "/cases/o_civil_case_history.php"
+        html = await self.getCaseHistory(case)
+        if self.responses and self.responses.hasResponse(case.cnr_number, endpoint, html):
+            return None
+        # Parsing is CPU bound, keep it off the event loop
+        newcase = (await asyncio.to_thread(CaseDetails, html, keep_html=False)).case
+        if self.responses:
+            self.pending_responses[newcase.cnr_number] = (case.cnr_number, endpoint, html)
+        if case.case_number:
+            newcase.case_number = case.case_number
+        return newcase
+
+    async def getOrdersOnDate(self, date: datetime.date):
+        d = date.strftime("%d-%m-%Y")
+        return parse_orders(await self._get_orders(from_date=d, to_date=d))
+
+    async def getCaseTypes(self) -> Iterator[CaseType]:
+        options = parse_options(await self._get_case_type())[1:]
+        return (CaseType(code=int(o[0]), description=o[1], court=self.court) for o in options)
+
+    @apimethod(
+        path="/cases/s_casetype_qry.php", csrf=True, court=True, action="fillCaseType"
+    )
+    async def _get_case_type(self, *args, **kwargs):
+        pass
+
+    @apimethod(
+        path="/cases/s_actwise_qry.php", csrf=False, court=True, action="fillActType"
+    )
+    async def _get_act_type(self, query: str, **kwargs):
+        return {
+            "search_act": query
+        }
+
+    async def getActTypes(self, query="") -> Iterator[ActType]:
+        options = parse_options(await self._get_act_type(query))[1:]
+        return (ActType(code=int(o[0]), description=o[1], court=self.court) for o in options)
+
+    async def getCauseLists(self, date: datetime.date) -> Iterator[CauseList]:
+        raw_res = await self._get_cause_lists(date)
+        return parse_cause_lists(raw_res)
+
+    @apimethod(
+        path="/cases/highcourt_causelist_qry.php",
+        court=True,
+        action="pulishedCauselist",
+        csrf=False
+    )
+    async def _get_cause_lists(self, date: datetime.date, **kwargs):
+        dt_str = date.strftime("%d-%m-%Y")
+        return {
+            "causelist_dt": dt_str,
+        }
@@ -4,14 +4,130 @@ import os
 import sys
 import os
 import sys
+import html
+import re
 import subprocess
-import tempfile
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 
 
 class CaptchaError(Exception):
     pass
 
 
+WHITELIST = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+# OCR backends are called with the cleaned image, and return the
+# recognised text along with a confidence (0-100) for every character.
+
+
+class TesseractProcess:
+    """
+    OCR backend that runs the tesseract binary once per image.
+    Slow, since every call pays for a process spawn and model load,
+    but needs nothing beyond tesseract itself.
+    """
+
+    name = "subprocess"
+    HOCR_CHAR = re.compile(r"<span class='ocrx_cinfo' title='[^']*x_conf ([\d.]+)'>([^<]*)</span>")
+    HOCR_WORD = re.compile(r"<span class='ocrx_word' [^>]*x_wconf (\d+)'>([^<]*)</span>")
+
+    def __call__(self, img: np.ndarray) -> tuple[str, list[float]]:
+        _, png = cv2.imencode(".png", img)
+        process = subprocess.run(
+            [
+                "tesseract",
+                "stdin",
+                "stdout",
+                "--oem",
+                "1",
+                "--psm",
+                "8",
+                "-c",
+                f"tessedit_char_whitelist={WHITELIST}",
+                "-c",
+                "hocr_char_boxes=1",
+                "hocr",
+            ],
+            input=png.tobytes(),
+            stdout=subprocess.PIPE,
+        )
+        return self.parse_hocr(process.stdout.decode("utf-8"))
+
+    def parse_hocr(self, hocr: str) -> tuple[str, list[float]]:
+        chars = self.HOCR_CHAR.findall(hocr)
+        if chars:
+            text = "".join(html.unescape(c) for _, c in chars).strip()
+            return text, [float(conf) for conf, c in chars if c.strip()]
+        # Older tesseract releases only report a confidence per word
+        text, confidences = "", []
+        for conf, word in self.HOCR_WORD.findall(hocr):
+            word = html.unescape(word).strip()
+            text += word
+            confidences += [float(conf)] * len(word)
+        return text, confidences
+
+
+class TesserocrAPI:
+    """
+    OCR backend that keeps a tesseract API handle alive in-process,
+    using tesserocr. The model is loaded once per thread, and images
+    are handed over as raw grayscale pixels.
+    """
+
+    name = "tesserocr"
+
+    def __init__(self):
+        import tesserocr
+
+        self.tesserocr = tesserocr
+        self._local = threading.local()
+
+    def api(self):
+        api = getattr(self._local, "api", None)
+        if api is None:
+            api = self.tesserocr.PyTessBaseAPI(
+                psm=self.tesserocr.PSM.SINGLE_WORD, oem=self.tesserocr.OEM.LSTM_ONLY
+            )
+            api.SetVariable("tessedit_char_whitelist", WHITELIST)
+            self._local.api = api
+        return api
+
+    def __call__(self, img: np.ndarray) -> tuple[str, list[float]]:
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[:2]
+        api = self.api()
+        api.SetImageBytes(img.tobytes(), width, height, 1, width)
+        api.Recognize()
+        level = self.tesserocr.RIL.SYMBOL
+        text, confidences = "", []
+        for symbol in self.tesserocr.iterate_level(api.GetIterator(), level):
+            char = (symbol.GetUTF8Text(level) or "").strip()
+            if char:
+                text += char
+                confidences.append(symbol.Confidence(level))
+        return text, confidences
+
+
+@lru_cache
+def ocr_backend(name: str = "auto"):
+    """
+    Returns a shared OCR backend by name: "tesserocr", "subprocess"
+    or "auto", which prefers tesserocr when it is installed.
+    """
+    if name in ("auto", "tesserocr"):
+        try:
+            return TesserocrAPI()
+        except ImportError:
+            if name == "tesserocr":
+                raise
+    if name in ("auto", "subprocess"):
+        return TesseractProcess()
+    raise ValueError(f"Unknown OCR backend: {name}")
+
+
 class Captcha:
     THRESHOLD = 0.4
     MAX_PIXEL_VALUE = 255
@@ -19,39 +135,158 @@ class Captcha:
         "https://hcservices.ecourts.gov.in/ecourtindiaHC/securimage/securimage_show.php"
     )
     SUFFIX = ".png"
+    HEADERS = {
+        "user-agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
+    }
+
+    ARCHIVE_LIMIT = 1000
 
-    def __init__(self, session=None, retry=100):
+    def __init__(self, session=None, retry=100, ocr=None, archive=None, archive_limit=ARCHIVE_LIMIT, min_confidence=0):
+        """
+        If `archive` is a directory, solved captchas that the server
+        accepted (see report()) are saved there as <result>.png (the
+        layout of test/fixtures/captcha) for use as training samples,
+        until it holds `archive_limit` images.
+
+        Captchas where any character was recognised with a confidence
+        below `min_confidence` (0-100) are discarded and fetched again,
+        instead of being submitted to the server.
+        """
         self.session = session
         self.retry = retry
+        self.ocr = ocr or ocr_backend()
+        self.archive = archive
+        self.archive_limit = archive_limit
+        self.archived = None
+        self.min_confidence = min_confidence
+        self.low_confidence = 0
+        # confidence bucket (multiple of 10) -> [accepted, rejected] by the server
+        self.outcomes = {}
+        # result -> (confidence, image) of captchas not yet reported
+        self._pending = {}
 
     def solve(self):
         if self.session == None:
             raise ValueError("Session object is required")
         while self.retry > 0:
-            captcha = self.session.get(self.URL, headers={
-                "user-agent": "Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0"
-            })
+            captcha = self.session.get(self.URL, headers=self.HEADERS)
 
             if captcha.status_code != 200:
                 continue
-            with tempfile.NamedTemporaryFile(suffix=self.SUFFIX, delete=False) as f:
-                f.write(captcha.content)
-                f.close()
-                try:
-                    res = self.decaptcha(f.name)
-                    self.retry = 100
-                    return res
-                except CaptchaError:
-                    if self.retry > 0:
-                        self.retry -= 1
-                    else:
-                        raise CaptchaError("Couldn't solve captcha after retries")
+            try:
+                res = self.decode(captcha.content)
+                self.retry = 100
+                return res
+            except CaptchaError:
+                if self.retry > 0:
+                    self.retry -= 1
+                else:
+                    raise CaptchaError("Couldn't solve captcha after retries")
+
+    def release(self):
+        """
+        Called once a request that used a captcha from solve()
+        has completed. No-op, see CaptchaPool.
+        """
+        pass
+
+    def report(self, result: str, accepted: bool):
+        """
+        Record whether the server accepted a captcha returned by solve(),
+        and archive it if it was
+        """
+        pending = self._pending.pop(result, None)
+        if pending is None:
+            return
+        confidence, content = pending
+        if accepted:
+            self.save(result, content)
+        bucket = min(int(confidence // 10) * 10, 90)
+        self.outcomes.setdefault(bucket, [0, 0])[0 if accepted else 1] += 1
+
+    def confidence_stats(self) -> dict:
+        """
+        Server side captcha rejections against local OCR confidence,
+        and the number of submissions skipped for low confidence.
+        """
+        accepted = sum(a for a, _ in self.outcomes.values())
+        rejected = sum(r for _, r in self.outcomes.values())
+        submitted = accepted + rejected
+        return {
+            "low_confidence": self.low_confidence,
+            "submitted": submitted,
+            "rejected": rejected,
+            "reject_rate": rejected / submitted if submitted else 0.0,
+            "buckets": {
+                bucket: {"accepted": a, "rejected": r, "reject_rate": r / (a + r)}
+                for bucket, (a, r) in sorted(self.outcomes.items())
+            },
+        }
+
+    def decode(self, content: bytes):
+        """
+        Solve a captcha from the raw image bytes, as returned by
+        the securimage endpoint.
+        """
+        return self.track(*self.recognise(content), content)
+
+    def recognise(self, content: bytes) -> tuple[str, float]:
+        """
+        The text of a captcha image, and the lowest confidence (0-100)
+        of its characters
+        """
+        src = None
+        if content:
+            src = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if src is None:
+            raise CaptchaError("Couldn't decode captcha image")
+        result, confidences = self.ocr(self.preprocess(src))
+        if len(result) != 5:
+            raise CaptchaError("Couldn't solve captcha")
+        return result, min(confidences, default=0)
+
+    def track(self, result: str, confidence: float, content: bytes) -> str:
+        """
+        Check a solved captcha against min_confidence, and keep it until
+        report() is called for it. Also used for captchas solved by a
+        CaptchaSolverPool.
+        """
+        if confidence < self.min_confidence:
+            self.low_confidence += 1
+            raise CaptchaError(f"Low confidence ({confidence:.0f}) in captcha")
+        if len(self._pending) > 16:
+            self._pending.clear()
+        self._pending[result] = (confidence, content)
+        return result
 
     def decaptcha(self, file):
         if not os.path.exists(file):
             raise FileNotFoundError(file)
+        with open(file, "rb") as f:
+            return self.decode(f.read())
+
+    def save(self, result: str, content: bytes):
+        """
+        Save a captcha and its solution to the archive directory, if enabled
+        """
+        if not self.archive:
+            return
+        if self.archived is None:
+            os.makedirs(self.archive, exist_ok=True)
+            self.archived = len(os.listdir(self.archive))
+        if self.archived >= self.archive_limit:
+            return
+        path = os.path.join(self.archive, f"{result}{self.SUFFIX}")
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(content)
+            self.archived += 1
 
-        src = cv2.imread(file)
+    def preprocess(self, src: np.ndarray) -> np.ndarray:
+        """
+        Clean up a BGR captcha image, and crop it down to the
+        grayscale glyphs that are passed on to the OCR backend.
+        """
         threshold = int(self.MAX_PIXEL_VALUE * self.THRESHOLD)
 
         _, threshold_img = cv2.threshold(
@@ -89,30 +324,137 @@ class Captcha:
         dst = cv2.cvtColor(dst, cv2.COLOR_BGR2GRAY)
         _, dst = cv2.threshold(dst, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
-        dst = dst[15:65, 27:190]  # crop the image
-        output_path = tempfile.mkstemp(suffix=".png")[1]
-        cv2.imwrite(output_path, dst)
+        return dst[15:65, 27:190]  # crop the image
 
-        process = subprocess.Popen(
-            [
-                "tesseract",
-                output_path,
-                "stdout",
-                "--oem",
-                "1",
-                "--psm",
-                "8",
-                "-c",
-                "tessedit_char_whitelist=abcdefghijklmnopqrstuvwxyz0123456789",
-            ],
-            stdout=subprocess.PIPE,
+
+class CaptchaPool:
+    """
+    Keeps an already solved captcha ready for the next query,
+    so the image fetch and OCR stay off the critical path.
+
+    The server only honours the last captcha issued to a session,
+    so the pool holds at most one captcha per session. A new one
+    is fetched in the background once the request that consumed the
+    previous one has completed (see release()), and captchas older
+    than `ttl` seconds are rejected as stale.
+    """
+
+    def __init__(self, captcha: Captcha, ttl: float = 120):
+        self.captcha = captcha
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.waited = 0.0
+        self._future = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="captcha")
+
+    def _fetch(self):
+        return (self.captcha.solve(), time.monotonic())
+
+    def prefetch(self):
+        if self._future is None:
+            self._future = self._executor.submit(self._fetch)
+
+    def release(self):
+        self.prefetch()
+
+    def report(self, result: str, accepted: bool):
+        self.captcha.report(result, accepted)
+
+    def confidence_stats(self) -> dict:
+        return self.captcha.confidence_stats()
+
+    def size(self) -> int:
+        """Number of solved captchas ready to be used."""
+        if self._future and self._future.done() and self._future.exception() is None:
+            return 1
+        return 0
+
+    def solve(self):
+        future, self._future = self._future, None
+        if future is not None:
+            start = time.monotonic()
+            try:
+                # Wait for an in-flight prefetch, since fetching another
+                # image would invalidate the one being solved.
+                res, fetched_at = future.result()
+            except Exception:
+                res = None
+            self.waited += time.monotonic() - start
+            if res is not None:
+                if time.monotonic() - fetched_at <= self.ttl:
+                    self.hits += 1
+                    return res
+                self.stale += 1
+        self.misses += 1
+        return self.captcha.solve()
+
+    def stats(self) -> dict:
+        served = self.hits + self.misses
+        return {
+            "size": self.size(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "stale": self.stale,
+            "hit_rate": self.hits / served if served else 0.0,
+            "waited": self.waited,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+_worker_captcha = None
+
+
+def _init_worker(ocr: str, min_confidence: float):
+    global _worker_captcha
+    _worker_captcha = Captcha(ocr=ocr_backend(ocr), min_confidence=min_confidence)
+
+
+def _solve_in_worker(content: bytes):
+    try:
+        result, confidence = _worker_captcha.recognise(content)
+    except CaptchaError:
+        return None, None
+    if confidence < _worker_captcha.min_confidence:
+        return None, confidence
+    return result, confidence
+
+
+class CaptchaSolverPool:
+    """
+    Solves captcha images across worker processes, so that the
+    OpenCV cleanup and OCR do not run on the calling thread.
+
+    Each worker holds its own Captcha with the `ocr` backend, and
+    every image comes back as (result, confidence). Images that could
+    not be solved have a result of None, and a confidence of None
+    unless they were discarded for being below `min_confidence`. Pass
+    solved ones to Captcha.track() to have report() account for them.
+    """
+
+    def __init__(self, workers: int = None, ocr: str = "auto", min_confidence: float = 0):
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(ocr, min_confidence)
         )
-        process.wait()
-        output, _ = process.communicate()
-        result = output.decode("utf-8").strip()
-        if len(result) == 5:
-            # rename the file to /tmp/result.png
-            os.rename(output_path, f"/tmp/{result}.png")
-            return result
-        else:
-            raise CaptchaError("Couldn't solve captcha")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, content: bytes) -> Future:
+        return self.executor.submit(_solve_in_worker, content)
+
+    def solve_many(self, images: list[bytes], chunksize: int = 4) -> list:
+        """
+        Solve a batch of captcha images, returning (result, confidence)
+        for each in the same order
+        """
+        return list(self.executor.map(_solve_in_worker, images, chunksize=chunksize))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
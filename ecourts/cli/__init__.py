@@ -1,15 +1,19 @@
 import click
 import csv
+import os
 import sys
+import urllib.parse
 from entities import Court
 from ecourt import ECourt, RetryException
 from sys import stdout
-from datetime import datetime
+from datetime import datetime, timedelta
 from storage import Storage
+from sessions import SessionPool
 from tabulate import tabulate
 import click
 from functools import wraps
 from parsers.cases import parse_cases
+from parsers.case_details import CaseDetails
 
 def validate_year(ctx, _, value):
     if value and (value < 1990 or value > 2025):
@@ -64,10 +68,25 @@ def common_options(f):
 
 
 @click.group()
+@click.option("--rate", type=float, help="Maximum requests per second to the ecourts website, across all courts")
+@click.option("--burst", type=float, default=1, help="Requests allowed in a burst, when using --rate")
+@click.option("--rate-lock", type=click.Path(dir_okay=False), help="Lock file to share the --rate limit between processes")
+@click.option("--wal", is_flag=True, help="Use WAL journaling, so several commands can share the database")
+@click.option("--archive", type=click.Path(file_okay=False), help="Keep every raw response in this directory, for reparse (needs zstandard)")
+@click.option("--parser", type=click.Choice(CaseDetails.BACKENDS), default=CaseDetails.BACKEND, help="HTML parser for case details, lxml is faster")
 @click.pass_context
-def ecourts(ctx):
+def ecourts(ctx, rate, burst, rate_lock, wal, archive, parser):
     """eCourts application for retrieving case information."""
     ctx.ensure_object(dict)
+    CaseDetails.BACKEND = parser
+    if archive:
+        from archive import ResponseArchive
+        ECourt.ARCHIVE = ResponseArchive(archive)
+    if wal:
+        Storage.WAL = True
+    if rate:
+        ECourt.RATE_LIMITER.lockfile = rate_lock
+        ECourt.RATE_LIMITER.set_rate(rate, burst)
 
 
 @ecourts.command()
@@ -195,11 +214,13 @@ def get_case_types(ctx, state_code, court_code, save):
     else:
         courts = [Court(state_code=state_code, court_code=court_code)]
 
+    pool = SessionPool()
+    s = Storage() if save else None
     for court in courts:
-        ecourt = ECourt(court)
+        ecourt = ECourt(court, session=pool.get(court))
         types = ecourt.getCaseTypes()
         if save:
-            Storage().addCaseTypes(types)
+            s.addCaseTypes(types)
 
 @ecourts.command()
 @click.argument("query")
@@ -226,11 +247,13 @@ def get_act_types(ctx, state_code, court_code, save):
     else:
         courts = [Court(state_code=state_code, court_code=court_code)]
 
+    pool = SessionPool()
+    s = Storage() if save else None
     for court in courts:
-        ecourt = ECourt(court)
+        ecourt = ECourt(court, session=pool.get(court))
         types = ecourt.getActTypes()
         if save:
-            Storage().addActTypes(types)
+            s.addActTypes(types)
 
 
 @ecourts.command()
@@ -248,8 +271,9 @@ def get_cause_lists(ctx, state_code, court_code, date: click.DateTime, save, max
     else:
         courts = [Court(state_code=state_code, court_code=court_code)]
 
+    pool = SessionPool()
     for court in courts:
-        ecourt = ECourt(court)
+        ecourt = ECourt(court, session=pool.get(court))
         ecourt.set_max_attempts(max_attempts)
         try:
             data = list(ecourt.getCauseLists(date.date()))
@@ -269,25 +293,34 @@ def get_cause_lists(ctx, state_code, court_code, date: click.DateTime, save, max
 @ecourts.command()
 @click.option("--cnr", help="Case CNR", required=False, type=str)
 @click.option("--download-orders", help="Download Orders", required=False, is_flag=True, default=False)
-def enrich_cases(cnr, download_orders):
+@click.option("--pool-size", help="Connections to keep alive to the ecourts website", type=int, default=10)
+@click.option("--refresh-after", help="Also refresh cases fetched more than this many days ago, or whose next hearing has passed", type=float)
+def enrich_cases(cnr, download_orders, pool_size, refresh_after):
     s = Storage()
-    for case_data in s.getCases():
-        if cnr:
-            if case_data['cnr_number'] != cnr:
-                continue
+    pool = SessionPool(pool_maxsize=pool_size)
+    clients = {}
+    if cnr:
         # cnr given = automatically force an update
-        if case_data['case_status'] != None and cnr == None:
-            continue
-        
+        cases = s.getCases(cnr=cnr)
+    elif refresh_after != None:
+        cases = s.getCases(stale_after=timedelta(days=refresh_after))
+    else:
+        cases = s.getCases(unexpanded=True)
+    for case_data in cases:
         court = Court(state_code=case_data['state_code'], court_code=case_data['court_code'])
 
         if 'case_type_int' not in case_data:
-            case_data['case_type_int'] = s.findCaseType(court, case_data['case_type'])
-            if case_data['case_type_int'] == None:
+            case_type = s.findCaseType(court, case_data['case_type'])
+            if case_type == None:
                 print("Case Type not found for " + case_data['cnr_number'])
                 continue
+            case_data['case_type_int'] = case_type.code
 
-        ecourt = ECourt(court)
+        key = (court.state_code, court.court_code or "1")
+        if key not in clients:
+            clients[key] = ECourt(court, session=pool.get(court))
+            clients[key].set_response_store(s)
+        ecourt = clients[key]
         registration_number = case_data['registration_number']
         # Search using case_type_int for now, we can move to number search, but that is heuristic really.
         cases = list(parse_cases(ecourt.searchSingleCase(registration_number, case_data['case_type_int'])))
@@ -296,10 +329,13 @@ def enrich_cases(cnr, download_orders):
         else:
             single_case = cases[0]
             new_case = ecourt.expand_case(single_case)
+            if new_case == None:
+                print(f"{case_data['cnr_number']} unchanged")
+                continue
             if new_case.registration_number != single_case.registration_number or registration_number != single_case.registration_number:
                 print("Case Details Mismatch" + case_data['cnr_number'])
             print(f"{new_case.cnr_number},{new_case.filing_number},{new_case.registration_number} {len(new_case.hearings)} Hearings, {len(new_case.orders)} Orders")
-            s.addCases(ecourt.court, [new_case])
+            s.addCases(ecourt.court, [new_case], responses=ecourt.take_responses([new_case]))
 
             if download_orders:
                 if new_case.orders:
@@ -309,6 +345,65 @@ def enrich_cases(cnr, download_orders):
                             continue
                         ecourt.downloadOrder(order, new_case, f"orders/{fn}.pdf")
 
+    stats = pool.stats()
+    click.echo(f"{stats['requests']} requests over {stats['connections']} connections, reuse ratio {stats['reuse_ratio']:.2f}", err=True)
+    click.echo(f"Skipped {s.skipped['parses']} unchanged pages and {s.skipped['writes']} unchanged cases", err=True)
+
+
+@ecourts.command()
+@click.argument("query")
+@click.option("--limit", type=int, default=20, help="Number of results")
+def search(query, limit):
+    """Search stored cases by party, advocate, coram or category."""
+    results = Storage().search(query, limit)
+    print(tabulate([
+        {"CNR": r["cnr_number"], "State": r["state_code"], "Court": r["court_code"], "Case": f"{r['case_type']} {r['registration_number']}", "Title": r["title"], "Status": r["case_status"]}
+        for r in results
+    ], headers="keys", tablefmt="presto"))
+
+
+@ecourts.command()
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--full", is_flag=True, help="Export every case, not just those changed since the last export")
+@click.option("--chunk-size", type=int, default=100_000, help="Rows written per Parquet file")
+def export(directory, full, chunk_size):
+    """Export the database to partitioned Parquet files (needs pyarrow)."""
+    from export import export_parquet
+
+    counts = export_parquet(Storage(), directory, incremental=not full, chunk_size=chunk_size)
+    for k, v in counts.items():
+        click.echo(f"{k}: {v}")
+
+
+@ecourts.command()
+@click.argument("directory", type=click.Path(file_okay=False, exists=True))
+@click.option("--workers", type=int, help="Parser processes, defaults to the number of CPUs")
+def reparse(directory, workers):
+    """Rebuild the database from a response archive, without any requests."""
+    from archive import ResponseArchive, reparse
+
+    counts = reparse(ResponseArchive(directory), Storage(), workers)
+    for k, v in counts.items():
+        click.echo(f"{k}: {v}")
+
+
+@ecourts.command()
+@click.argument("directory", type=click.Path(file_okay=False, exists=True))
+@click.option("--state-code", required=True, help="State code of the Court")
+@click.option("--court-code", help="Court code of the Court")
+@click.option("--pattern", default="*.html", show_default=True, help="Files to parse in DIRECTORY")
+@click.option("--workers", type=int, help="Parser processes, defaults to the number of CPUs")
+def parse_dir(directory, state_code, court_code, pattern, workers):
+    """Save the cases from a directory of case history pages."""
+    from parse_dir import parse_dir
+
+    court = Court(state_code=state_code, court_code=court_code)
+    stats = parse_dir(directory, court, Storage(), workers, pattern)
+    click.echo(f"Parsed {stats['cases']} cases from {stats['files']} files, {stats['errors']} errors, in {stats['seconds']:.1f}s")
+    for pid, worker in sorted(stats["workers"].items()):
+        rate = worker["files"] / worker["seconds"] if worker["seconds"] else 0.0
+        click.echo(f"worker {pid}: {worker['files']} files, {rate:.1f} files/s")
+
 
 @ecourts.command()
 def stats():
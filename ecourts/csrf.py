@@ -0,0 +1,65 @@
+import re
+from typing import Optional
+
+
+class CSRFError(Exception):
+    pass
+
+
+class CSRFToken:
+    """
+    Keeps the csrf-magic token (__csrf_magic) for a session.
+
+    The token is seeded with a known value, and refreshed from the
+    search pages whenever one is fetched anyway, or when the server
+    rejects it. Each refresh costs a single GET.
+    """
+
+    NAME = "__csrf_magic"
+    PATTERN = re.compile(
+        r"""csrfMagicToken\s*=\s*"([^"]+)"|name=['"]__csrf_magic['"]\s+value=['"]([^'"]+)['"]"""
+    )
+    # Printed by csrf-magic's default csrf_callback, along with a 403
+    REJECTION = "CSRF check failed"
+
+    def __init__(self, session=None, url: Optional[str] = None, token: Optional[str] = None):
+        """
+        session: requests.Session used to scrape the token
+        url: a page of the session's court that embeds the token
+        token: the initial token, fetched from url on first use if not set
+        """
+        self.session = session
+        self.url = url
+        self.token = token
+        self.refreshes = 0
+
+    def params(self) -> dict:
+        if self.token is None:
+            self.refresh()
+        return {self.NAME: self.token}
+
+    def parse(self, html: str) -> Optional[str]:
+        match = self.PATTERN.search(html)
+        if match:
+            return match.group(1) or match.group(2)
+        return None
+
+    def update(self, html: str) -> bool:
+        """
+        Pick up the token from a page that was already fetched
+        """
+        token = self.parse(html)
+        if token:
+            self.token = token
+        return token != None
+
+    def refresh(self):
+        if self.session == None or self.url == None:
+            raise ValueError("Session object and url are required")
+        self.refreshes += 1
+        r = self.session.get(self.url, timeout=(5, 10))
+        if not self.update(r.text):
+            raise CSRFError(f"No {self.NAME} token found at {self.url}")
+
+    def rejected(self, response) -> bool:
+        return response.status_code == 403 or self.REJECTION in response.text[0:500]
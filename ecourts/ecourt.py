@@ -1,7 +1,12 @@
 import os
 import requests
-from captcha import Captcha, CaptchaError
+from captcha import Captcha, CaptchaError, CaptchaPool
+from csrf import CSRFToken, CSRFError
+from ratelimit import LIMITER, RateLimitedAdapter
+from retry import CallStats, Failure, RetryPolicy, SessionExpiredError
+from collections import deque
 from collections.abc import Iterator
+from typing import Optional
 from tempfile import mkstemp
 import time
 from urllib.parse import urlencode
@@ -19,18 +24,179 @@ class RetryException(Exception):
     pass
 
 
+class ApiCall:
+    """
+    The state of a single apimethod call across its attempts: the request
+    parameters, csrf refreshes, captcha reporting, retry decisions, stats
+    and archiving. Shared by ECourt and AsyncECourt, which only differ in
+    how they send requests and wait between attempts.
+    """
+
+    # Retried failures, besides the client's own transport errors
+    ERRORS = (CaptchaError, CSRFError, SessionExpiredError, ValueError)
+
+    def __init__(self, client, path: str, court: bool, csrf: bool, action: Optional[str]):
+        self.client = client
+        self.path = path
+        self.csrf = csrf
+        self.params = {"action_code": action} if action else {}
+        if court:
+            self.params |= client.court.queryParams()
+        self.attempts = client.attempts()
+        self.csrf_refreshed = False
+        # After a transport error the captcha was never checked, so reuse it
+        self.reuse_params = False
+        self.posting = False
+        self.stats = CallStats(path)
+        client.call_log.append(self.stats)
+
+    def add_csrf(self):
+        """
+        Called first in every attempt, before the apimethod itself
+        """
+        if self.csrf:
+            self.params |= self.client.csrf.params()
+
+    def start(self, extra_params: Optional[dict], kwargs: dict) -> dict:
+        """
+        The parameters for the next attempt. extra_params is what the
+        apimethod returned, None when the last attempt's are reused.
+        """
+        if not self.reuse_params:
+            self.params |= extra_params or kwargs
+        self.reuse_params = False
+        if 'captcha' in self.params and self.params['captcha'] == None:
+            raise RetryException("Ran out of captcha attempts")
+        self.posting = True
+        self.stats.attempts += 1
+        return self.params
+
+    def csrf_rejected(self, response) -> bool:
+        """
+        Whether to refresh the csrf token and try again. A stale token
+        costs one refresh, not a retry.
+        """
+        self.posting = False
+        if 'captcha' in self.params:
+            self.client.captcha.release()
+        if self.csrf and not self.csrf_refreshed and self.client.csrf.rejected(response):
+            self.csrf_refreshed = True
+            return True
+        return False
+
+    def check(self, response):
+        """
+        Validate a response, reporting to the captcha solver whether its
+        captcha was accepted. Raises one of ERRORS if it should be retried.
+        """
+        try:
+            self.client.validate_response(response)
+        except CaptchaError:
+            if 'captcha' in self.params:
+                self.client.captcha.report(self.params['captcha'], False)
+            raise
+        if 'captcha' in self.params:
+            self.client.captcha.report(self.params['captcha'], True)
+        if response.status_code == 302 and response.headers['location'].startswith("errormsg"):
+            raise ValueError("Error: " + response.headers['location'])
+        # httpx raises for redirects too, requests only for 4xx/5xx
+        if response.status_code >= 400:
+            response.raise_for_status()
+
+    def failed(self, e: Exception, session) -> float:
+        """
+        Record a failed attempt, and return the seconds to wait before the
+        next one. Raises RetryException once out of attempts. session is the
+        client's requests.Session or httpx.AsyncClient, to reset on expiry.
+        """
+        failure = self.client.retry_policy.classify(e)
+        count = self.stats.record(failure)
+        self.attempts -= 1
+        if self.attempts == 0:
+            self.stats.finish()
+            raise RetryException(f"Ran out of {self.client.attempts()} attempts, still failed") from e
+        if failure == Failure.TRANSPORT and self.posting and 'captcha' in self.params:
+            self.reuse_params = True
+        if failure == Failure.SESSION_EXPIRED:
+            session.cookies.clear()
+        delay = self.client.retry_policy.delay(failure, count)
+        self.stats.slept += max(delay, 0)
+        return delay
+
+    def finish(self, response) -> str:
+        self.stats.finish()
+        text = response.content.decode("utf-8-sig", errors="replace")
+        if ECourt.ARCHIVE:
+            ECourt.ARCHIVE.add(self.path, self.params, self.client.court, text)
+        return text
+
+
 class ECourt:
-    # TODO: Get this dynamically at init
+    # Last known token, used until a fresh one is picked up (see CSRFToken)
     CSRF_MAGIC_PARAMS = {
         "__csrf_magic": "sid:e2b2b2ae5e125f3174066a01e182acd472a256ea,1723269931"
     }
     BASE_URL = "https://hcservices.ecourts.gov.in/ecourtindiaHC"
+    CALL_LOG_SIZE = 1000
+    RATE_LIMITER = LIMITER
+    # A ResponseArchive to keep every apimethod response in, off by default
+    ARCHIVE = None
 
-    def __init__(self, court: Court):
-        self.session = requests.Session()
+    def __init__(self, court: Court, session: requests.Session = None):
+        """
+        Pass a session from a SessionPool to reuse connections across courts.
+        """
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", RateLimitedAdapter(self.RATE_LIMITER))
+        self.session = session
         self.court = court
         self.captcha = Captcha(self.session)
+        self.csrf = CSRFToken(self.session, self.search_page_url(), self.CSRF_MAGIC_PARAMS["__csrf_magic"])
         self.max_attempts = 15
+        self.retry_policy = RetryPolicy()
+        # CallStats for the most recent apimethod calls
+        self.call_log = deque(maxlen=self.CALL_LOG_SIZE)
+        self.responses = None
+        # cnr_number -> (cnr_number, endpoint, content) parsed but not yet saved
+        self.pending_responses = {}
+
+    def set_response_store(self, storage):
+        """
+        Keep raw case history pages in storage (see Storage.hasResponse),
+        so that expand_case skips parsing pages that haven't changed. Pass
+        take_responses(cases) to storage.addCases along with the expanded
+        cases, to record the pages they were parsed from.
+        """
+        self.responses = storage
+
+    def take_responses(self, cases: list[Case]) -> list[tuple[str, str, str]]:
+        """
+        The pending raw responses that cases were parsed from, for
+        Storage.addCases(responses=). They are removed from this client.
+        """
+        return [r for case in cases if (r := self.pending_responses.pop(case.cnr_number, None))]
+
+    def set_retry_policy(self, policy: RetryPolicy):
+        self.retry_policy = policy
+
+    def enable_captcha_prefetch(self, ttl: float = 120) -> CaptchaPool:
+        """
+        Solve the next captcha in the background while other requests
+        are in flight. Pool statistics are available via self.captcha.stats()
+        """
+        if not isinstance(self.captcha, CaptchaPool):
+            self.captcha = CaptchaPool(self.captcha, ttl)
+            self.captcha.prefetch()
+        return self.captcha
+
+    def set_min_captcha_confidence(self, confidence: float):
+        """
+        Discard captchas solved with a lower OCR confidence (0-100) without
+        submitting them. Outcomes are tracked in self.captcha.confidence_stats()
+        """
+        captcha = self.captcha.captcha if isinstance(self.captcha, CaptchaPool) else self.captcha
+        captcha.min_confidence = confidence
 
     def set_max_attempts(self, attempts):
         self.max_attempts = attempts
@@ -43,54 +209,38 @@ class ECourt:
             return self.BASE_URL + path + "?" + urlencode(queryParams)
         return self.BASE_URL + path
 
+    def search_page_url(self):
+        cc = self.court.court_code or "1"
+        return self.url(f"/cases/s_casetype.php?state_cd={self.court.state_code}&dist_cd=1&court_code={cc}")
+
     def validate_response(self, r):
         t = r.text.upper()[0:30]
         if "ERROR" in t:
             raise ValueError("Got invalid result")
         if "INVALID CAPTCHA" in t:
             raise CaptchaError()
+        if "session expired" in r.text:
+            raise SessionExpiredError()
 
     def apimethod(path, court=False, csrf=True, action=None):
         def decorator(func):
             def inner(self, *args, **kwargs):
-                params = {"action_code": action} if action else {}
-                if court:
-                    params |= self.court.queryParams()
-                if csrf:
-                    params |= self.CSRF_MAGIC_PARAMS
-
-                attempts = self.attempts()
-
-                while attempts > 0:
+                call = ApiCall(self, path, court, csrf, action)
+                while True:
                     try:
-                        extra_params = func(self, *args, **kwargs) or {}
-                        if len(extra_params) == 0:
-                            params |= kwargs
-                        else:
-                            params |= extra_params
-                        if 'captcha' in params and params['captcha'] == None:
-                            print("Ran out captcha attempts")
-                            sys.exit(1)
-
+                        call.add_csrf()
+                        extra_params = None if call.reuse_params else func(self, *args, **kwargs)
+                        params = call.start(extra_params, kwargs)
                         response = self.session.post(self.url(path), data=params, allow_redirects=False, timeout=(5, 10))
-                        self.validate_response(response)
-                        if response.status_code == 302 and response.headers['location'].startswith("errormsg"):
-                            raise ValueError("Error: " + response.headers['location'])
-                        response.raise_for_status()
-                        attempts = 0
-                    except (CaptchaError, ValueError, requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
-                        time.sleep(1)
-                        attempts -= 1
-                        if attempts == 0:
-                            raise RetryException(f"Ran out of {self.attempts()} attempts, still failed")
-                    except (requests.exceptions.HTTPError) as e:
-                        time.sleep(1)
-                        attempts -= 1
-                        if attempts == 0:
-                            raise RetryException(f"Ran out of {self.attempts()} attempts, still failed")
-
-                response.encoding = "utf-8-sig"
-                return response.text
+                        if call.csrf_rejected(response):
+                            self.csrf.refresh()
+                            continue
+                        call.check(response)
+                        return call.finish(response)
+                    except ApiCall.ERRORS + (requests.exceptions.RequestException,) as e:
+                        delay = call.failed(e, self.session)
+                        if delay > 0:
+                            time.sleep(delay)
 
             return inner
 
@@ -159,9 +309,8 @@ class ECourt:
         return r
 
     def CaseType(self, case_type: str, status: str, year: int = None):
-        cc = self.court.court_code or "1"
-        url = self.url(f"/cases/s_casetype.php?state_cd={self.court.state_code}&dist_cd=1&court_code={cc}")
-        self.session.get(url)
+        r = self.session.get(self.search_page_url())
+        self.csrf.update(r.text)
         result = self._search_cases_by_case_type(case_type, status, year)
         return parse_cases(result)
 
@@ -201,10 +350,20 @@ class ECourt:
             "displayOldCaseNo": "NO"
         }
 
-    def expand_case(self, case: Case):
+    def expand_case(self, case: Case) -> Optional[Case]:
+        """
+        Fetch and parse the case details. With a response store set, returns
+        None if the page is the same as when the case was last saved, and
+        keeps the page for take_responses otherwise.
+        """
         from parsers.case_details import CaseDetails
+        endpoint = "/cases/o_civil_case_history.php"
         html = self.getCaseHistory(case)
-        newcase = CaseDetails(html).case
+        if self.responses and self.responses.hasResponse(case.cnr_number, endpoint, html):
+            return None
+        newcase = CaseDetails(html, keep_html=False).case
+        if self.responses:
+            self.pending_responses[newcase.cnr_number] = (case.cnr_number, endpoint, html)
         if case.case_number:
             newcase.case_number = case.case_number
         return newcase
@@ -85,14 +85,12 @@ class Case:
             "case_no": self.case_number
         }
 
-    def __getattribute__(self, name):
-        if name == 'name':
-            if len(self.petitioners) > 0 and len(self.respondents) > 0:
-                return self.petitioners[0].name + " vs " + self.respondents[0].name
-            else:
-                return None
+    @property
+    def name(self):
+        if len(self.petitioners) > 0 and len(self.respondents) > 0:
+            return self.petitioners[0].name + " vs " + self.respondents[0].name
         else:
-            return super().__getattribute__(name)
+            return None
 
     def json(self) -> dict:
         """
@@ -0,0 +1,139 @@
+import json
+import os
+import uuid
+from datetime import datetime
+from typing import Optional
+from storage import Storage
+
+# Partition columns, added to every exported table. The year is the
+# filing year, the last 4 digits of the CNR.
+PARTITION_SQL = "c.state_code AS state_code, c.court_code AS court_code, substr(c.cnr_number, -4) AS year"
+
+# table name -> (select list, from clause, columns that aren't strings)
+TABLES = {
+    "cases": (
+        """
+        c.cnr_number, c.case_type, c.registration_number, c.case_status, c.category,
+        c.decision_date, c.updated_at, c.updated_seq,
+        json_extract(c.value, '$.filing_number') AS filing_number,
+        json_extract(c.value, '$.registration_date') AS registration_date,
+        json_extract(c.value, '$.first_hearing_date') AS first_hearing_date,
+        json_extract(c.value, '$.filing_date') AS filing_date,
+        json_extract(c.value, '$.nature_of_disposal') AS nature_of_disposal,
+        json_extract(c.value, '$.coram') AS coram,
+        json_extract(c.value, '$.bench') AS bench,
+        json_extract(c.value, '$.state') AS state,
+        json_extract(c.value, '$.district') AS district,
+        json_extract(c.value, '$.judicial') AS judicial,
+        json_extract(c.value, '$.case_number') AS case_number,
+        json_extract(c.value, '$.sub_category') AS sub_category,
+        json_extract(c.value, '$.not_before_me') AS not_before_me,
+        json_extract(c.value, '$.status') AS status,
+        json_extract(c.value, '$.act_type') AS act_type,
+        CAST(json_extract(c.value, '$.case_type_int') AS TEXT) AS case_type_int,
+        json_extract(c.value, '$.fir') AS fir,
+        json_extract(c.value, '$.objections') AS objections
+        """,
+        "cases c",
+        {"updated_seq": "int64"},
+    ),
+    "hearings": (
+        """
+        c.cnr_number, c.updated_at, c.updated_seq, h.idx, h.date, h.next_date,
+        json_extract(h.value, '$.cause_list_type') AS cause_list_type,
+        json_extract(h.value, '$.judge') AS judge,
+        json_extract(h.value, '$.purpose') AS purpose,
+        json_extract(h.value, '$.court_no') AS court_no,
+        json_extract(h.value, '$.srno') AS srno,
+        json_extract(h.value, '$.details') AS details
+        """,
+        "cases c JOIN case_hearings h ON h.cnr_number = c.cnr_number",
+        {"updated_seq": "int64", "idx": "int64", "srno": "int64"},
+    ),
+    "orders": (
+        """
+        c.cnr_number, c.updated_at, c.updated_seq, o.idx, o.date, o.filename,
+        json_extract(o.value, '$.judge') AS judge,
+        json_extract(o.value, '$.judgement') = 1 AS judgement
+        """,
+        "cases c JOIN case_orders o ON o.cnr_number = c.cnr_number",
+        {"updated_seq": "int64", "idx": "int64", "judgement": "bool_"},
+    ),
+    "parties": (
+        "c.cnr_number, c.updated_at, c.updated_seq, p.role, p.idx, p.name, p.advocate",
+        "cases c JOIN case_parties p ON p.cnr_number = c.cnr_number",
+        {"updated_seq": "int64", "idx": "int64"},
+    ),
+}
+
+WATERMARK_FILE = "_watermark.json"
+
+
+def read_watermark(directory: str) -> Optional[int]:
+    """
+    The updated_seq of the last case change exported to directory. None
+    for a new directory, or one from before updated_seq, which then gets
+    a full export.
+    """
+    try:
+        with open(os.path.join(directory, WATERMARK_FILE)) as f:
+            return json.load(f).get("updated_seq")
+    except FileNotFoundError:
+        return None
+
+
+def export_parquet(storage: Storage, directory: str, incremental: bool = True, chunk_size: int = 100_000) -> dict[str, int]:
+    """
+    Export the stored cases, hearings, orders and parties to Parquet
+    files under directory/<table>/, hive partitioned by state_code,
+    court_code and year, so that pandas, DuckDB or Spark can read
+    them directly.
+
+    Rows are read and written chunk_size at a time, within a single read
+    transaction. The updated_seq of the last case change is kept in the
+    directory, and with incremental=True, the next export only writes
+    cases changed after it (and their hearings, orders and parties) as
+    new files. Every table has the case's updated_at and updated_seq, so
+    readers should keep the rows with the highest updated_seq per
+    cnr_number, in every table.
+
+    Returns the number of rows written per table. Needs pyarrow, which is
+    part of the parquet extra.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    os.makedirs(directory, exist_ok=True)
+    watermark = read_watermark(directory) if incremental else None
+    run = f"{datetime.now():%Y%m%d%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+    counts = {}
+    storage.conn.execute("BEGIN")
+    try:
+        latest = storage.conn.execute("SELECT max(updated_seq) FROM cases").fetchone()[0]
+        for table, (columns, source, types) in TABLES.items():
+            counts[table] = 0
+            where = "WHERE c.updated_seq > ?" if watermark is not None else ""
+            cursor = storage.conn.execute(
+                f"SELECT {PARTITION_SQL}, {columns} FROM {source} {where}",
+                (watermark,) if watermark is not None else (),
+            )
+            names = [d[0] for d in cursor.description]
+            schema = pa.schema([(name, getattr(pa, types.get(name, "string"))()) for name in names])
+            chunk = 0
+            while rows := cursor.fetchmany(chunk_size):
+                data = pa.Table.from_pylist([dict(zip(names, row)) for row in rows], schema=schema)
+                pq.write_to_dataset(
+                    data,
+                    os.path.join(directory, table),
+                    partition_cols=["state_code", "court_code", "year"],
+                    basename_template=f"{run}-{chunk}-{{i}}.parquet",
+                )
+                counts[table] += len(rows)
+                chunk += 1
+    finally:
+        storage.conn.commit()
+
+    if latest is not None:
+        with open(os.path.join(directory, WATERMARK_FILE), "w") as f:
+            json.dump({"updated_seq": latest}, f)
+    return counts
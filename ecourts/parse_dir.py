@@ -0,0 +1,83 @@
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from entities import Case, Court
+
+
+def _parse_file(args):
+    from parsers.case_details import CaseDetails
+
+    filename, backend = args
+    start = time.perf_counter()
+    try:
+        with open(filename) as f:
+            result = CaseDetails(f.read(), backend=backend, keep_html=False).case
+    except Exception as e:
+        result = e
+    return filename, os.getpid(), time.perf_counter() - start, result
+
+
+def _save(storage, court: Court, batch: list[Case], stats: dict):
+    try:
+        storage.addCases(court, batch)
+        stats["cases"] += len(batch)
+        return
+    except Exception:
+        pass
+    # Find the cases that can't be written, one at a time
+    for case in batch:
+        try:
+            storage.addCases(court, [case])
+            stats["cases"] += 1
+        except Exception as e:
+            stats["errors"] += 1
+            print(f"Error saving {case.cnr_number}: {e!r}", file=sys.stderr)
+
+
+def parse_dir(
+    directory: str,
+    court: Court,
+    storage,
+    workers: Optional[int] = None,
+    pattern: str = "*.html",
+    backend: Optional[str] = None,
+) -> dict:
+    """
+    Parse every saved case history page (o_civil_case_history.php)
+    matching pattern in directory, in parallel across workers processes,
+    and write the cases to storage in batches of storage.BATCH_SIZE, as
+    cases of court. Files that fail to parse, and cases that fail to be
+    written, are reported and skipped.
+
+    Returns the number of "files", saved "cases" and "errors", the wall
+    clock "seconds", and per worker pid, the files it parsed and the
+    seconds it spent parsing them under "workers".
+    """
+    from parsers.case_details import CaseDetails
+
+    backend = backend or CaseDetails.BACKEND
+    files = sorted(glob.glob(os.path.join(directory, pattern)))
+    stats = {"files": len(files), "cases": 0, "errors": 0, "seconds": 0.0, "workers": {}}
+    start = time.perf_counter()
+    batch = []
+    with ProcessPoolExecutor(workers) as executor:
+        jobs = ((filename, backend) for filename in files)
+        for filename, pid, seconds, result in executor.map(_parse_file, jobs, chunksize=8):
+            worker = stats["workers"].setdefault(pid, {"files": 0, "seconds": 0.0})
+            worker["files"] += 1
+            worker["seconds"] += seconds
+            if isinstance(result, Exception):
+                stats["errors"] += 1
+                print(f"Error parsing {filename}: {result!r}", file=sys.stderr)
+                continue
+            batch.append(result)
+            if len(batch) >= storage.BATCH_SIZE:
+                _save(storage, court, batch, stats)
+                batch = []
+    if batch:
+        _save(storage, court, batch, stats)
+    stats["seconds"] = time.perf_counter() - start
+    return stats
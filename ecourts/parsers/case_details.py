@@ -1,5 +1,5 @@
 from dataclasses import dataclass
-from collections import OrderedDict
+from functools import cached_property
 from datetime import datetime
 from typing import Optional
 from bs4 import BeautifulSoup
@@ -11,8 +11,76 @@ from entities import Case, Party, Hearing, Order, Objection, Court, FIR
 
 
 class CaseDetails:
+    # BeautifulSoup tree builders that give the same results. html5lib is
+    # the reference, lxml is several times faster but needs the lxml package.
+    BACKENDS = ["html5lib", "lxml"]
+    BACKEND = "html5lib"
+    # html5lib follows the HTML spec and reads a stray </br> as <br>, lxml drops it
+    END_BR = re.compile(r"</br\s*>", re.IGNORECASE)
+    CASE_STATUS = re.compile("Case Status")
+    PARTY_CLASSES = ["Petitioner_Advocate_table", "Respondent_Advocate_table"]
+    PARTY = re.compile(r"\d\)\s+(?P<party>[^\n]+)(?:(?:\s|\n)+Advocate\s*-\s*(?P<advocate>[^\n]+))?", re.MULTILINE)
+    FIR_FIELD = re.compile(r"(?P<k>.*):\s?(?P<v>(\w|\d| )+)\s?", re.MULTILINE)
+    # function viewBusiness(court_code,dist_code,n_dt,case_number,state_code,businessStatus,todays_date1,court_no,srno)
+    VIEW_BUSINESS = (
+        ("court_code", str),
+        ("district_code", str),
+        ("next_date", str),
+        ("case_number", str),
+        ("state_code", str),
+        ("disposal_flag", str),
+        ("business_date", str),
+        ("court_no", str),
+        ("srno", str),
+    )
 
-    def extract_span_label_dict(self, soup: BeautifulSoup) -> dict[str, str]:
+    def walk(self, soup: BeautifulSoup) -> dict:
+        """
+        Visit the document once, replacing every <br> with a newline, and
+        pick out the nodes that each section is extracted from. Sections
+        that follow a heading table are found in the table after it.
+        """
+        sections = {"case_details": [], "category": [], "objection": []}
+        tables = []
+        for node in soup.find_all(True):
+            if node.name == "br":
+                node.replace_with("\n")
+                continue
+            classes = node.get("class") or []
+            if "case_details_table" in classes:
+                sections["case_details"].append(node)
+            if node.name == "span":
+                for cls in ["FIR_details_table"] + self.PARTY_CLASSES:
+                    if cls in classes and cls not in sections:
+                        sections[cls] = node
+            elif node.name == "h2":
+                if "case_status" not in sections and node.string and self.CASE_STATUS.search(node.string):
+                    sections["case_status"] = node
+            elif node.name == "table":
+                tables.append(node)
+
+        # Only now, after the <br>s are gone, is the table text final
+        pending = []
+        for table in tables:
+            for section in pending:
+                if section == "history":
+                    sections["history"] = table
+                else:
+                    sections[section].append(table)
+            pending = []
+            if table.get("id") == "historyheading" and "historyheading" not in sections:
+                sections["historyheading"] = table
+                pending.append("history")
+            if "order_table" in (table.get("class") or []) and "orders" not in sections:
+                sections["orders"] = table
+            text = table.text
+            if "Category Details" in text:
+                pending.append("category")
+            if "OBJECTION" in text:
+                pending.append("objection")
+        return sections
+
+    def extract_span_label_dict(self, containers: list) -> dict[str, str]:
         """
         Extracts key-value pairs from case_details_table spans, 
         using primary next_sibling method and a text-splitting fallback.
@@ -25,7 +93,8 @@ class CaseDetails:
         details = {}
         
         # Find all labels in case_details_table spans
-        for label in soup.select('.case_details_table label'):
+        labels = [label for container in containers for label in container.find_all("label")]
+        for label in labels:
             key = label.text.strip()
             
             # Validate key contains at least one known check string
@@ -61,46 +130,44 @@ class CaseDetails:
             details[key] = value.replace("\xa0", "").strip()
         
         return details
-    def extract_case_details(self, soup: BeautifulSoup) -> dict:
-        return self.extract_span_label_dict(soup)
+    def extract_case_details(self, sections: dict) -> dict:
+        return self.extract_span_label_dict(sections["case_details"])
 
-    def extract_fir_details(self, soup: BeautifulSoup) -> dict:
-        d = soup.select_one("span.FIR_details_table")
+    def extract_fir_details(self, sections: dict) -> dict:
+        d = sections.get("FIR_details_table")
         if d:
             s = d.text.replace("\xa0", "").strip()
-            regex = r"(?P<k>.*):\s?(?P<v>(\w|\d| )+)\s?"
-            matches = re.finditer(regex, s, re.MULTILINE)
+            matches = self.FIR_FIELD.finditer(s)
             fir_details = {}
             for matchNum, match in enumerate(matches, start=1):
                 fir_details[match.group("k")] = match.group("v").strip()
             return fir_details
 
-    def extract_case_status(self, soup: BeautifulSoup) -> dict:
-        case_status_div = soup.find("h2", string=re.compile("Case Status"))
+    def extract_case_status(self, sections: dict) -> dict:
+        case_status_div = sections.get("case_status")
         case_status = {}
 
         if case_status_div == None:
-            breakpoint()
+            raise ValueError("No case status on the page")
 
         next_sibling = None
         for next_sibling in case_status_div.next_siblings:
             if next_sibling.name:
                 break
 
-        for row in next_sibling.select("label"):
+        for row in next_sibling.find_all("label"):
             if row.name == "label":
                 [key, value] = row.find_all("strong")
                 case_status[key.text.strip()] = value.text.split(":")[1].strip()
         return case_status
 
-    def extract_parties(self, soup: BeautifulSoup, spanClass: str) -> list[Party]:
-        table = soup.find("span", class_=spanClass)
+    def extract_parties(self, sections: dict, spanClass: str) -> list[Party]:
+        table = sections.get(spanClass)
         if not table:
             raise ValueError("NO TABLES")
             return []
         s = table.text.replace("\xa0", "").strip()
-        regex = r"\d\)\s+(?P<party>[^\n]+)(?:(?:\s|\n)+Advocate\s*-\s*(?P<advocate>[^\n]+))?"
-        matches = re.finditer(regex, s, re.MULTILINE)
+        matches = self.PARTY.finditer(s)
         parties = []
         for matchNum, match in enumerate(matches, start=1):
             party = Party(name=match.group("party").strip())
@@ -109,10 +176,9 @@ class CaseDetails:
             parties.append(party)
         return parties
 
-    def extract_hearing(self, soup: BeautifulSoup) -> list[Hearing]:
-        f = soup.find("table", id="historyheading")
-        if f:
-            history_table = f.find_next("table")
+    def extract_hearing(self, sections: dict) -> list[Hearing]:
+        if "historyheading" in sections:
+            history_table = sections.get("history")
         else:
             return []
         history = []
@@ -127,23 +193,9 @@ class CaseDetails:
                     cause_list_type = None
                 if cause_list_type == "Order Number":
                     break
-                if cells[2].select_one("a"):
-                    # function viewBusiness(court_code,dist_code,n_dt,case_number,state_code,businessStatus,todays_date1,court_no,srno)
-
-                    signature = OrderedDict(
-                        [
-                            ("court_code", str),
-                            ("district_code", str),
-                            ("next_date", str),
-                            ("case_number", str),
-                            ("state_code", str),
-                            ("disposal_flag", str),
-                            ("business_date", str),
-                            ("court_no", str),
-                            ("srno", str),
-                        ]
-                    )
-                    res = parse_js_call(cells[2].select_one("a")["onclick"], signature)
+                link = cells[2].find("a")
+                if link:
+                    res = parse_js_call(link["onclick"], self.VIEW_BUSINESS)
                     # We don't need court details since they should be in the parent entity
                     # # breakpoint()
                     # court = Court(
@@ -169,26 +221,21 @@ class CaseDetails:
                 )
         return history
 
-    def extract_orders(self, soup: BeautifulSoup) -> list[Order]:
+    def extract_orders(self, sections: dict) -> list[Order]:
         orders = []
-        ordertable = soup.find("table", class_="order_table")
+        ordertable = sections.get("orders")
         if ordertable == None:
-            import pytest
-            pytest.set_trace()
+            return orders
         for row in ordertable.find_all("tr")[1:]:
-            try:
-                (_, caseno, judge, date, details) = row.find_all("td")
-            except ValueError:
-                print(row.find_all("td"))
-            
+            cells = row.find_all("td")
+            if len(cells) != 5:
+                raise ValueError(f"Expected 5 cells in an order row, got {len(cells)}")
+            (_, caseno, judge, date, details) = cells
 
-            link = details.select_one("a")
-            url = None
-            if link:
-                url = link["href"]
-            else:
-                print(soup)
-                breakpoint()
+            link = details.find("a")
+            if not link:
+                raise ValueError(f"No link to the order of {date.text.strip()}")
+            url = link["href"]
 
             query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
             orders.append(
@@ -200,52 +247,54 @@ class CaseDetails:
             )
         return orders
 
-    def extract_category_details(self, soup: BeautifulSoup) -> dict:
+    def extract_category_details(self, sections: dict) -> dict:
         category_details = {}
-        for t in soup.find_all("table"):
-            if "Category Details" in t.text:
-                category_table = t.find_next("table")
-                if category_table:
-                    for row in category_table.find_all("tr"):
-                        (key, value) = row.find_all("td")
-                        category_details[key.text.strip()] = value.text.strip()
+        for category_table in sections["category"]:
+            for row in category_table.find_all("tr"):
+                (key, value) = row.find_all("td")
+                category_details[key.text.strip()] = value.text.strip()
         return category_details
 
-    def extract_objection(self, soup: BeautifulSoup) -> list[Objection]:
+    def extract_objection(self, sections: dict) -> list[Objection]:
         objections = []
-        for t in soup.find_all("table"):
-            if "OBJECTION" in t.text:
-                objection_table = t.find_next("table")
-                if objection_table:
-                    for row in objection_table.find_all("tr")[1:]:
-                        (
-                            _,
-                            scrutiny_date,
-                            objection_text,
-                            compliance_date,
-                            receipt_date,
-                        ) = row.find_all("td")
-                        objections.append(
-                            Objection(
-                                scrutiny_date=scrutiny_date.text.strip(),
-                                objection=objection_text.text.strip(),
-                                compliance_date=compliance_date.text.strip(),
-                                receipt_date=receipt_date.text.strip(),
-                            )
-                        )
+        for objection_table in sections["objection"]:
+            for row in objection_table.find_all("tr")[1:]:
+                (
+                    _,
+                    scrutiny_date,
+                    objection_text,
+                    compliance_date,
+                    receipt_date,
+                ) = row.find_all("td")
+                objections.append(
+                    Objection(
+                        scrutiny_date=scrutiny_date.text.strip(),
+                        objection=objection_text.text.strip(),
+                        compliance_date=compliance_date.text.strip(),
+                        receipt_date=receipt_date.text.strip(),
+                    )
+                )
         return objections
 
-    def __init__(self, html_content: str):
+    def __init__(self, html_content: str, backend: Optional[str] = None, keep_html: bool = True):
+        """
+        backend: one of BACKENDS, CaseDetails.BACKEND by default
+        keep_html: keep the parsed page around for .html. With False, the
+        tree is freed as soon as .case is extracted.
+        """
         if "session expired" in html_content:
             raise ValueError("Session expired")
 
-        soup = BeautifulSoup(html_content, "html5lib")
-
-        for br in soup.find_all("br"):
-            br.replace_with("\n")
+        backend = backend or self.BACKEND
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown backend {backend}, use one of {self.BACKENDS}")
+        if backend == "lxml":
+            html_content = self.END_BR.sub("<br>", html_content)
+        soup = BeautifulSoup(html_content, backend)
+        sections = self.walk(soup)
 
-        case_details = self.extract_case_details(soup)
-        fir_details = self.extract_fir_details(soup)
+        case_details = self.extract_case_details(sections)
+        fir_details = self.extract_fir_details(sections)
         fir = None
         if fir_details:
             fir = FIR(
@@ -255,13 +304,13 @@ class CaseDetails:
                 number=fir_details.get("FIR Number"),
                 year=fir_details.get("Year"),
             )
-        case_status = self.extract_case_status(soup)
-        petitioners = self.extract_parties(soup, "Petitioner_Advocate_table")
-        respondents = self.extract_parties(soup, "Respondent_Advocate_table")
-        hearings = self.extract_hearing(soup)
-        category_details = self.extract_category_details(soup)
-        objections = self.extract_objection(soup)
-        orders = self.extract_orders(soup)
+        case_status = self.extract_case_status(sections)
+        petitioners = self.extract_parties(sections, "Petitioner_Advocate_table")
+        respondents = self.extract_parties(sections, "Respondent_Advocate_table")
+        hearings = self.extract_hearing(sections)
+        category_details = self.extract_category_details(sections)
+        objections = self.extract_objection(sections)
+        orders = self.extract_orders(sections)
 
         self.case = Case(
             case_type=case_details.get("Case Type"),
@@ -292,4 +341,20 @@ class CaseDetails:
             orders=orders,
             fir=fir,
         )
-        self.html = clean_html(soup)
+        if keep_html:
+            self._soup = soup
+        else:
+            self._soup = None
+            # Break the tree's reference cycles now, instead of waiting for the gc
+            soup.decompose()
+
+    @cached_property
+    def html(self) -> str:
+        """
+        The page, minified by clean_html. Computed on first use.
+        """
+        if self._soup is None:
+            raise ValueError("CaseDetails was created with keep_html=False")
+        html = clean_html(self._soup)
+        self._soup = None
+        return html
@@ -1,8 +1,22 @@
-from collections import OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
 import datetime
 from typing import Optional
 import re
 
+JS_ARGS = re.compile(r"\((.*)\)")
+
+DATE_FORMATS = (
+    "%Y%m%d",
+    "%d-%m-%Y",
+    "%dth %B %Y",
+    "%dst %B %Y",
+    "%dnd %B %Y",
+)
+# The two formats the website uses for almost every date, read without strptime
+YYYYMMDD = re.compile(r"(\d{4})(\d{2})(\d{2})")
+DD_MM_YYYY = re.compile(r"(\d{1,2})-(\d{1,2})-(\d{4})")
+
 
 def parse_js_call(js_call, signature):
     """
@@ -10,22 +24,26 @@ def parse_js_call(js_call, signature):
 
     Args:
       js_call: The JavaScript function call as a string.
-      signature: An OrderedDict mapping argument names to their types.
+      signature: (name, type) pairs for the arguments, in order, such as a
+        tuple, or a mapping of argument names to their types. It is not
+        modified, so it can be a constant.
 
     Returns:
       A dictionary of typed arguments.
     """
 
     # Extract arguments from the JavaScript function call
-    args_str = re.search(r"\((.*)\)", js_call).group(1)
-    args = [arg.strip() for arg in args_str.split(",")]
+    args_str = JS_ARGS.search(js_call).group(1)
+    args = args_str.split(",")
+    if isinstance(signature, Mapping):
+        signature = signature.items()
 
     # Convert arguments to typed values based on the signature
     typed_args = {}
-    while signature:
-        key, type_ = signature.popitem(last=False)
-        arg = args.pop(0)
-        arg = arg.strip("'\"")  # Remove leading and trailing quotes
+    for i, (key, type_) in enumerate(signature):
+        if i >= len(args):
+            raise ValueError(f"Missing argument {key} in {js_call}")
+        arg = args[i].strip().strip("'\"")  # Remove leading and trailing quotes
         try:
             typed_args[key] = type_(arg)
         except ValueError:
@@ -34,17 +52,27 @@ def parse_js_call(js_call, signature):
     return typed_args
 
 
+@lru_cache(maxsize=4096)
 def parse_date(date_str: Optional[str]) -> Optional[datetime.date]:
+    """
+    Parse a date in any of DATE_FORMATS, or return None. Dates before
+    2050 only. Results are cached, the same dates repeat across cases.
+    """
     if not date_str:
         return None
-    date_formats = [
-        "%Y%m%d",
-        "%d-%m-%Y",
-        "%dth %B %Y",
-        "%dst %B %Y",
-        "%dnd %B %Y",
-    ]
-    for fmt in date_formats:
+    match = YYYYMMDD.fullmatch(date_str)
+    if match:
+        year, month, day = match.groups()
+    elif match := DD_MM_YYYY.fullmatch(date_str):
+        day, month, year = match.groups()
+    if match:
+        try:
+            x = datetime.date(int(year), int(month), int(day))
+            return x if x.year < 2050 else None
+        except ValueError:
+            # Let strptime decide, as it did before
+            pass
+    for fmt in DATE_FORMATS:
         try:
             x = datetime.datetime.strptime(date_str, fmt).date()
             if x.year < 2050:
@@ -0,0 +1,147 @@
+import re
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second, holding
+    at most `burst` tokens. Thread safe.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self, tokens: float, updated: float, now: float) -> float:
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        return tokens - 1
+
+    def reserve(self) -> float:
+        """
+        Take a token, returning the number of seconds to wait before using it
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = self._take(self.tokens, self.updated, now)
+            self.updated = now
+            return max(0.0, -self.tokens / self.rate)
+
+
+class FileTokenBucket(TokenBucket):
+    """
+    A token bucket whose state lives in a small file guarded by
+    flock(2), so that it is shared by every process using that file.
+    """
+
+    def __init__(self, filename: str, rate: float, burst: float = 1):
+        super().__init__(rate, burst)
+        self.filename = filename
+
+    def reserve(self) -> float:
+        import fcntl
+
+        with self.lock, open(self.filename, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            now = time.time()
+            try:
+                tokens, updated = (float(x) for x in f.read().split())
+            except ValueError:
+                tokens, updated = self.burst, now
+            tokens = self._take(tokens, updated, now)
+            f.seek(0)
+            f.truncate()
+            f.write(f"{tokens} {now}")
+            return max(0.0, -tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Rate limits requests by URL path. Every path shares the default
+    bucket, unless it was given its own rate with set_rate(path=...).
+    A path matches if the request path ends with it, so
+    "/cases/s_casetype_qry.php" works as well as the full path.
+
+    If `lockfile` is set, the buckets are shared across processes.
+    """
+
+    def __init__(self, rate: Optional[float] = None, burst: float = 1, lockfile: Optional[str] = None):
+        self.lockfile = lockfile
+        self.rates = {}
+        self.buckets = {}
+        self.waited = 0.0
+        self.lock = threading.Lock()
+        if rate:
+            self.set_rate(rate, burst)
+
+    def set_rate(self, rate: Optional[float], burst: float = 1, path: Optional[str] = None):
+        """
+        Set the requests/second for a path, or the default if path is None.
+        A rate of None removes the limit.
+        """
+        with self.lock:
+            if rate:
+                self.rates[path] = (rate, burst)
+            else:
+                self.rates.pop(path, None)
+            self.buckets.pop(path, None)
+
+    def _bucket(self, url: str) -> Optional[TokenBucket]:
+        path = urlparse(url).path
+        # set_rate may change rates from another thread
+        with self.lock:
+            key = next((p for p in self.rates if p and path.endswith(p)), None)
+            if key not in self.rates:
+                return None
+            if key not in self.buckets:
+                rate, burst = self.rates[key]
+                if self.lockfile:
+                    suffix = re.sub(r"\W+", "_", key or "").strip("_")
+                    filename = f"{self.lockfile}.{suffix}" if suffix else self.lockfile
+                    self.buckets[key] = FileTokenBucket(filename, rate, burst)
+                else:
+                    self.buckets[key] = TokenBucket(rate, burst)
+            return self.buckets[key]
+
+    def reserve(self, url: str) -> float:
+        bucket = self._bucket(url)
+        if bucket is None:
+            return 0.0
+        delay = bucket.reserve()
+        self.waited += delay
+        return delay
+
+    def acquire(self, url: str) -> float:
+        """
+        Block until a request to url is allowed, returning the time waited
+        """
+        delay = self.reserve(url)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+LIMITER = RateLimiter()
+"""The process wide rate limiter, shared by all ECourt instances."""
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    A requests transport adapter that waits on a RateLimiter
+    before sending each request.
+    """
+
+    def __init__(self, limiter: RateLimiter = LIMITER, **kwargs):
+        self.limiter = limiter
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire(request.url)
+        return super().send(request, **kwargs)
@@ -0,0 +1,83 @@
+import random
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from captcha import CaptchaError
+from csrf import CSRFError
+
+
+class SessionExpiredError(Exception):
+    pass
+
+
+class Failure(Enum):
+    CAPTCHA = "captcha"
+    """The server rejected the captcha."""
+
+    TRANSPORT = "transport"
+    """Timeouts and connection errors, no usable response was received."""
+
+    SERVER = "server"
+    """HTTP errors, and error responses from the server."""
+
+    SESSION_EXPIRED = "session_expired"
+    """The server side session is gone, and needs to be started afresh."""
+
+
+class RetryPolicy:
+    """
+    Decides how long apimethod waits before retrying a failed request.
+
+    Captcha and session failures are retried immediately, transport
+    errors after a fixed delay, and server errors with exponential
+    backoff and jitter, capped at `cap` seconds.
+
+    Subclass it and override classify() or delay() for other behaviour.
+    """
+
+    def __init__(self, base: float = 1, cap: float = 30, transport_delay: float = 1):
+        self.base = base
+        self.cap = cap
+        self.transport_delay = transport_delay
+
+    def classify(self, exc: Exception) -> Failure:
+        if isinstance(exc, CaptchaError):
+            return Failure.CAPTCHA
+        if isinstance(exc, SessionExpiredError):
+            return Failure.SESSION_EXPIRED
+        # HTTP errors from both requests and httpx carry the response
+        if isinstance(exc, (ValueError, CSRFError)) or getattr(exc, "response", None) is not None:
+            return Failure.SERVER
+        return Failure.TRANSPORT
+
+    def delay(self, failure: Failure, count: int) -> float:
+        """
+        Seconds to wait after the `count`th failure of this kind in a call
+        """
+        if failure == Failure.SERVER:
+            d = min(self.cap, self.base * 2 ** (count - 1))
+            return d / 2 + random.uniform(0, d / 2)
+        if failure == Failure.TRANSPORT:
+            return self.transport_delay
+        return 0
+
+
+@dataclass
+class CallStats:
+    """
+    Attempts made by a single apimethod call, for profiling
+    """
+
+    path: str
+    attempts: int = 0
+    slept: float = 0.0
+    elapsed: float = 0.0
+    failures: dict[Failure, int] = field(default_factory=dict)
+    started: float = field(default_factory=time.monotonic, repr=False)
+
+    def record(self, failure: Failure) -> int:
+        self.failures[failure] = self.failures.get(failure, 0) + 1
+        return self.failures[failure]
+
+    def finish(self):
+        self.elapsed = time.monotonic() - self.started
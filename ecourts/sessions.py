@@ -0,0 +1,66 @@
+import requests
+from entities import Court
+from ratelimit import LIMITER, RateLimiter, RateLimitedAdapter
+
+
+class SessionPool:
+    """
+    Hands out one requests.Session per court, all sharing a single
+    pooled transport. Every court keeps its own cookie jar (and hence
+    server session, captcha and csrf token), while TCP+TLS connections
+    to the ecourts website are kept alive and reused across courts.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 4,
+        pool_maxsize: int = 10,
+        keep_alive: bool = True,
+        limiter: RateLimiter = LIMITER,
+    ):
+        """
+        pool_connections: number of hosts to keep connection pools for
+        pool_maxsize: connections kept alive per host
+        keep_alive: if False, connections are closed after every request
+        """
+        self.keep_alive = keep_alive
+        self.adapter = RateLimitedAdapter(
+            limiter, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.sessions = {}
+
+    def get(self, court: Court) -> requests.Session:
+        key = (court.state_code, court.court_code or "1")
+        if key not in self.sessions:
+            session = requests.Session()
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+            if not self.keep_alive:
+                session.headers["Connection"] = "close"
+            self.sessions[key] = session
+        return self.sessions[key]
+
+    def stats(self) -> dict:
+        """
+        Connection reuse across all sessions: the number of requests
+        sent, new connections opened for them, and the reuse ratio.
+        """
+        requests_sent = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool:
+                requests_sent += pool.num_requests
+                connections += pool.num_connections
+        return {
+            "sessions": len(self.sessions),
+            "requests": requests_sent,
+            "connections": connections,
+            "reuse_ratio": 1 - connections / requests_sent if requests_sent else 0.0,
+        }
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+        self.adapter.close()
+        self.sessions = {}
@@ -2,7 +2,169 @@ from entities import CaseType, Court, Case,ActType, CaseType
 import sqlite3
 from typing import Optional
 import json
+import hashlib
+import queue
+import threading
+import zlib
 from collections.abc import Iterator
+from datetime import datetime, timedelta
+from itertools import islice
+
+
+# Case fields that are stored as rows in child tables instead of the value blob
+CASE_CHILD_FIELDS = ["hearings", "orders", "petitioners", "respondents"]
+
+# The full text search row of every case, by the case's id
+CASES_FTS_SQL = """
+    SELECT c.id,
+        (SELECT name FROM case_parties WHERE cnr_number = c.cnr_number AND role = 'petitioner' ORDER BY idx LIMIT 1)
+            || ' vs ' ||
+        (SELECT name FROM case_parties WHERE cnr_number = c.cnr_number AND role = 'respondent' ORDER BY idx LIMIT 1),
+        (SELECT group_concat(name, ' ') FROM case_parties WHERE cnr_number = c.cnr_number),
+        (SELECT group_concat(advocate, ' ') FROM case_parties WHERE cnr_number = c.cnr_number),
+        json_extract(c.value, '$.coram'),
+        c.category
+    FROM cases c
+"""
+
+# Each migration is a list of statements, run in a single transaction.
+# Version 1 is the original schema, version 2 adds stored columns for
+# the frequently queried case fields, and moves hearings, orders and
+# parties out of the cases table.
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS case_types (value JSON)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_case_types ON case_types(json_extract(value, '$.code'), json_extract(value, '$.court_state_code'), json_extract(value, '$.court_court_code'))",
+        "CREATE TABLE IF NOT EXISTS act_types (value JSON)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_act_types ON act_types(json_extract(value, '$.code'), json_extract(value, '$.court_state_code'), json_extract(value, '$.court_court_code'))",
+        "CREATE TABLE IF NOT EXISTS courts (value JSON)",
+        "CREATE TABLE IF NOT EXISTS cases (state_code, court_code, value JSON)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_cases_cnr ON cases(json_extract(value, '$.cnr_number'))",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_cases_caseno ON cases(state_code, court_code, json_extract(value, '$.case_type'), json_extract(value, '$.registration_number'))",
+        "CREATE INDEX IF NOT EXISTS idx_cases_category ON cases(json_extract(value, '$.category'))",
+    ],
+    [
+        """CREATE TABLE cases_v2 (
+            state_code TEXT,
+            court_code TEXT,
+            value JSON,
+            cnr_number TEXT GENERATED ALWAYS AS (json_extract(value, '$.cnr_number')) STORED,
+            case_type TEXT GENERATED ALWAYS AS (json_extract(value, '$.case_type')) STORED,
+            registration_number TEXT GENERATED ALWAYS AS (json_extract(value, '$.registration_number')) STORED,
+            case_status TEXT GENERATED ALWAYS AS (json_extract(value, '$.case_status')) STORED,
+            category TEXT GENERATED ALWAYS AS (json_extract(value, '$.category')) STORED,
+            decision_date TEXT GENERATED ALWAYS AS (json_extract(value, '$.decision_date')) STORED
+        )""",
+        """CREATE TABLE case_hearings (
+            cnr_number TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            value JSON,
+            date TEXT GENERATED ALWAYS AS (json_extract(value, '$.date')) STORED,
+            next_date TEXT GENERATED ALWAYS AS (json_extract(value, '$.next_date')) STORED,
+            PRIMARY KEY (cnr_number, idx)
+        )""",
+        """CREATE TABLE case_orders (
+            cnr_number TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            value JSON,
+            date TEXT GENERATED ALWAYS AS (json_extract(value, '$.date')) STORED,
+            filename TEXT GENERATED ALWAYS AS (json_extract(value, '$.filename')) STORED,
+            PRIMARY KEY (cnr_number, idx)
+        )""",
+        """CREATE TABLE case_parties (
+            cnr_number TEXT NOT NULL,
+            role TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            name TEXT,
+            advocate TEXT,
+            PRIMARY KEY (cnr_number, role, idx)
+        )""",
+        "INSERT INTO cases_v2 (state_code, court_code, value) SELECT state_code, court_code, json_remove(value, '$.hearings', '$.orders', '$.petitioners', '$.respondents') FROM cases",
+        "INSERT INTO case_hearings (cnr_number, idx, value) SELECT json_extract(c.value, '$.cnr_number'), j.key, j.value FROM cases c, json_each(c.value, '$.hearings') j",
+        "INSERT INTO case_orders (cnr_number, idx, value) SELECT json_extract(c.value, '$.cnr_number'), j.key, j.value FROM cases c, json_each(c.value, '$.orders') j",
+        "INSERT INTO case_parties SELECT json_extract(c.value, '$.cnr_number'), 'petitioner', j.key, json_extract(j.value, '$.name'), json_extract(j.value, '$.advocate') FROM cases c, json_each(c.value, '$.petitioners') j",
+        "INSERT INTO case_parties SELECT json_extract(c.value, '$.cnr_number'), 'respondent', j.key, json_extract(j.value, '$.name'), json_extract(j.value, '$.advocate') FROM cases c, json_each(c.value, '$.respondents') j",
+        "DROP TABLE cases",
+        "ALTER TABLE cases_v2 RENAME TO cases",
+        "CREATE UNIQUE INDEX idx_cases_cnr ON cases(cnr_number)",
+        "CREATE UNIQUE INDEX idx_cases_caseno ON cases(state_code, court_code, case_type, registration_number)",
+        "CREATE INDEX idx_cases_category ON cases(category, case_status)",
+        "CREATE INDEX idx_cases_status ON cases(case_status)",
+        "CREATE INDEX idx_cases_decision_date ON cases(decision_date)",
+        "CREATE INDEX idx_case_hearings_next_date ON case_hearings(next_date)",
+    ],
+    [
+        "ALTER TABLE cases ADD COLUMN updated_at TEXT",
+        "CREATE INDEX idx_cases_updated_at ON cases(updated_at)",
+    ],
+    [
+        "CREATE INDEX idx_case_types_court ON case_types(json_extract(value, '$.court_state_code'), ifnull(json_extract(value, '$.court_court_code'), '1'))",
+    ],
+    [
+        # Filled in by version 8, once cases have a stable id to key it on
+        "CREATE VIRTUAL TABLE cases_fts USING fts5(title, parties, advocates, coram, category, tokenize = 'unicode61 remove_diacritics 2')",
+    ],
+    [
+        "ALTER TABLE cases ADD COLUMN fetched_at TEXT",
+        "ALTER TABLE cases ADD COLUMN content_hash TEXT",
+        "ALTER TABLE cases ADD COLUMN next_hearing_date TEXT",
+        "UPDATE cases SET next_hearing_date = (SELECT max(next_date) FROM case_hearings h WHERE h.cnr_number = cases.cnr_number)",
+        "CREATE INDEX idx_cases_fetched_at ON cases(fetched_at)",
+        "CREATE INDEX idx_cases_next_hearing_date ON cases(next_hearing_date)",
+    ],
+    [
+        """CREATE TABLE raw_responses (
+            cnr_number TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            body BLOB,
+            fetched_at TEXT,
+            PRIMARY KEY (cnr_number, endpoint)
+        )""",
+    ],
+    [
+        # An explicit INTEGER PRIMARY KEY, which unlike the implicit rowid is
+        # never renumbered by VACUUM, so that cases_fts rows stay with their case
+        """CREATE TABLE cases_v8 (
+            id INTEGER PRIMARY KEY,
+            state_code TEXT,
+            court_code TEXT,
+            value JSON,
+            cnr_number TEXT GENERATED ALWAYS AS (json_extract(value, '$.cnr_number')) STORED,
+            case_type TEXT GENERATED ALWAYS AS (json_extract(value, '$.case_type')) STORED,
+            registration_number TEXT GENERATED ALWAYS AS (json_extract(value, '$.registration_number')) STORED,
+            case_status TEXT GENERATED ALWAYS AS (json_extract(value, '$.case_status')) STORED,
+            category TEXT GENERATED ALWAYS AS (json_extract(value, '$.category')) STORED,
+            decision_date TEXT GENERATED ALWAYS AS (json_extract(value, '$.decision_date')) STORED,
+            updated_at TEXT,
+            fetched_at TEXT,
+            content_hash TEXT,
+            next_hearing_date TEXT
+        )""",
+        """INSERT INTO cases_v8 (id, state_code, court_code, value, updated_at, fetched_at, content_hash, next_hearing_date)
+            SELECT rowid, state_code, court_code, value, updated_at, fetched_at, content_hash, next_hearing_date FROM cases""",
+        "DROP TABLE cases",
+        "ALTER TABLE cases_v8 RENAME TO cases",
+        "CREATE UNIQUE INDEX idx_cases_cnr ON cases(cnr_number)",
+        "CREATE UNIQUE INDEX idx_cases_caseno ON cases(state_code, court_code, case_type, registration_number)",
+        "CREATE INDEX idx_cases_category ON cases(category, case_status)",
+        "CREATE INDEX idx_cases_status ON cases(case_status)",
+        "CREATE INDEX idx_cases_decision_date ON cases(decision_date)",
+        "CREATE INDEX idx_cases_updated_at ON cases(updated_at)",
+        "CREATE INDEX idx_cases_fetched_at ON cases(fetched_at)",
+        "CREATE INDEX idx_cases_next_hearing_date ON cases(next_hearing_date)",
+        "DELETE FROM cases_fts",
+        f"INSERT INTO cases_fts (rowid, title, parties, advocates, coram, category) {CASES_FTS_SQL}",
+    ],
+    [
+        # A counter that moves with every change to a case. Writers take turns,
+        # so unlike updated_at it never goes back, for incremental exports.
+        "ALTER TABLE cases ADD COLUMN updated_seq INTEGER",
+        "UPDATE cases SET updated_seq = id",
+        "CREATE INDEX idx_cases_updated_seq ON cases(updated_seq)",
+    ],
+]
+SCHEMA_VERSION = len(MIGRATIONS)
 
 
 class Storage:
@@ -15,38 +177,93 @@ class Storage:
     sqlite json extension.
     """
 
-    def __init__(self, filename="ecourts.db"):
+    # Used when Storage is created without wal=, set by the CLI's --wal
+    WAL = False
+    # Seconds to wait on a locked database before giving up
+    BUSY_TIMEOUT = 30
+    PRAGMAS = {
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+    }
+
+    def __init__(self, filename="ecourts.db", wal: Optional[bool] = None):
+        """
+        wal: switch the database to WAL journaling with the PRAGMAS above,
+        so readers never block the writer. The journal mode sticks to the
+        database file once set.
+        """
         self.filename = filename
-        self.conn = sqlite3.connect(self.filename)
-        cursor = self.conn.cursor()
-        cursor.execute("CREATE TABLE IF NOT EXISTS case_types (value JSON)")
-        cursor.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_case_types ON case_types(json_extract(value, '$.code'), json_extract(value, '$.court_state_code'), json_extract(value, '$.court_court_code'))"
-        )
+        self.conn = sqlite3.connect(self.filename, timeout=self.BUSY_TIMEOUT)
+        # (state_code, court_code) -> {description or its prefix: CaseType}
+        self._case_types = {}
+        # Responses and case writes skipped because nothing changed
+        self.skipped = {"parses": 0, "writes": 0}
+        if self.WAL if wal is None else wal:
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            for pragma, value in self.PRAGMAS.items():
+                self.conn.execute(f"PRAGMA {pragma} = {value}")
+        self.migrate()
 
-        cursor.execute("CREATE TABLE IF NOT EXISTS act_types (value JSON)")
-        cursor.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_act_types ON act_types(json_extract(value, '$.code'), json_extract(value, '$.court_state_code'), json_extract(value, '$.court_court_code'))"
-        )
-        cursor.execute("CREATE TABLE IF NOT EXISTS courts (value JSON)")
-        cursor.execute("CREATE TABLE IF NOT EXISTS cases (state_code, court_code, value JSON)")
-        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_cases_cnr ON cases(json_extract(value, '$.cnr_number'))")
-        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_cases_caseno ON cases(state_code, court_code, json_extract(value, '$.case_type'), json_extract(value, '$.registration_number'))")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_cases_category ON cases(json_extract(value, '$.category'))")
-        cursor.close()
-        self.conn.commit()
+    def migrate(self):
+        """
+        Bring the database schema up to SCHEMA_VERSION, running every
+        pending migration in its own transaction. The version is
+        tracked in PRAGMA user_version.
+        """
+        # Opening an up to date database shouldn't wait on its writers
+        if self.conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return
+        while True:
+            # Take the write lock before reading the version again, so that
+            # concurrent connections don't run the same migration twice
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    self.conn.commit()
+                    return
+                for statement in MIGRATIONS[version]:
+                    self.conn.execute(statement)
+                self.conn.execute(f"PRAGMA user_version = {version + 1}")
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
 
     def close(self):
         self.conn.close()
 
     def findCaseType(self, court: Court, case_type: str) -> Optional[CaseType]:
-        for ct in self.getCaseTypes():
-            if case_type == ct.description:
-                return ct
-            if ct.description.startswith(case_type + " - "):
-                return ct
+        """
+        Find the court's case type by its full description, or by the
+        abbreviation before " - ", or None if the court has no such case
+        type. The case types of a court are loaded once, and looked up
+        from memory after that.
+        """
+        key = (court.state_code, court.court_code or "1")
+        if key not in self._case_types:
+            self._case_types[key] = self._load_case_types(*key)
+        return self._case_types[key].get(case_type)
 
-        raise ValueError(f"Case Type not found for {court} {case_type}")
+    def _load_case_types(self, state_code: str, court_code: str) -> dict[str, CaseType]:
+        by_description = {}
+        for (value,) in self.conn.execute(
+            "SELECT value FROM case_types WHERE json_extract(value, '$.court_state_code') = ? AND ifnull(json_extract(value, '$.court_court_code'), '1') = ?",
+            (state_code, court_code),
+        ):
+            j = json.loads(value)
+            ct = CaseType(
+                code=j["code"],
+                description=j["description"],
+                court=Court(state_code=j["court_state_code"], court_code=j["court_court_code"]),
+            )
+            by_description[ct.description] = ct
+            parts = ct.description.split(" - ")
+            for i in range(1, len(parts)):
+                by_description.setdefault(" - ".join(parts[:i]), ct)
+        return by_description
 
     def addCaseTypes(self, records: list[CaseType]):
         for record in records:
@@ -55,6 +272,7 @@ class Storage:
                 (json.dumps(dict(record)),),
             )
         self.conn.commit()
+        self._case_types = {}
 
     def getCaseTypes(self):
         r = self.conn.execute("SELECT value FROM case_types")
@@ -90,42 +308,431 @@ class Storage:
             )
         self.conn.commit()
 
+    # Fields of an existing case that are kept on update, unless set in extra_fields
+    CASE_PATCH_FIELDS = ["status", "year", "act_type", "case_type"]
+    BATCH_SIZE = 1000
+
     #TODO: Move storage to under ecourts.storage so we get court information from there
-    def addCases(self, court: Court, cases: list[Case], extra_fields: dict={}):
-        cursor = self.conn.cursor()
-        for case in cases:
-            # search for the record using CNR
-            # if found, update the record
-            # if not found, insert the record
-            search_result = cursor.execute(
-                "SELECT value FROM cases WHERE json_extract(value, '$.cnr_number') = ?", (case.cnr_number,)
+    def addCases(self, court: Court, cases: list[Case], extra_fields: dict={}, responses: list[tuple[str, str, str]] = []):
+        """
+        Insert or update cases, matched by CNR number.
+
+        New cases are stored with extra_fields merged in. Existing cases are
+        replaced by the new data, except for CASE_PATCH_FIELDS which keep their
+        stored value unless given in extra_fields.
+
+        Cases are written with one upsert per case, in batches of BATCH_SIZE
+        per transaction. Hearings, orders and parties are replaced in their
+        own tables along with the case.
+
+        Every case records when it was last fetched (fetched_at), its next
+        hearing, and a hash of its content. Cases whose hash is unchanged
+        are not written again, only their fetched_at moves.
+
+        If a batch has the same case more than once, the last one is stored.
+
+        responses are the raw (cnr_number, endpoint, content) the cases were
+        parsed from, see hasResponse. Each is stored in the same transaction
+        as its case, so a page is only ever known once its case is saved.
+        Changed cases written without a response forget their stored pages.
+        """
+        court_code = court.court_code or "1"
+        cases = iter(cases)
+        while batch := list(islice(cases, self.BATCH_SIZE)):
+            rows = list({row["cnr_number"]: row for row in (case.json() for case in batch)}.values())
+            hashes = [self._content_hash(row | extra_fields) for row in rows]
+            with self.conn:
+                stored = dict(self.conn.execute(
+                    f"SELECT cnr_number, content_hash FROM cases WHERE cnr_number IN ({','.join('?' * len(rows))})",
+                    [row["cnr_number"] for row in rows],
+                ))
+                # Unchanged cases are only marked as fetched
+                unchanged = [(row["cnr_number"],) for row, h in zip(rows, hashes) if stored.get(row["cnr_number"]) == h]
+                self.conn.executemany("UPDATE cases SET fetched_at = datetime('now') WHERE cnr_number = ?", unchanged)
+                self.skipped["writes"] += len(unchanged)
+                cnrs = {row["cnr_number"] for row in rows}
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO raw_responses VALUES (?, ?, ?, ?, datetime('now'))",
+                    (
+                        (cnr_number, endpoint, hashlib.sha256(content.encode()).hexdigest(), zlib.compress(content.encode()))
+                        for cnr_number, endpoint, content in responses
+                        if cnr_number in cnrs
+                    ),
+                )
+                changed = [(row, h) for row, h in zip(rows, hashes) if stored.get(row["cnr_number"]) != h]
+                if not changed:
+                    continue
+                # A case overwritten without its page no longer holds what was
+                # parsed from the stored page, so that page must be parsed again
+                with_response = {cnr_number for cnr_number, _, _ in responses}
+                self.conn.executemany(
+                    "DELETE FROM raw_responses WHERE cnr_number = ?",
+                    ((row["cnr_number"],) for row, _ in changed if row["cnr_number"] not in with_response),
+                )
+                self.conn.executemany(
+                    self._upsert_sql(extra_fields, changed[0][0].keys()),
+                    (
+                        (
+                            court.state_code,
+                            court_code,
+                            json.dumps(self._case_value(row) | extra_fields, default=str),
+                            h,
+                            self._next_hearing_date(row),
+                        )
+                        for row, h in changed
+                    ),
+                )
+                self._replace_children([row for row, _ in changed])
+                self._index_cases([row for row, _ in changed])
+
+    def hasResponse(self, cnr_number: str, endpoint: str, content: str) -> bool:
+        """
+        Returns True if content is the raw response of endpoint that the case
+        was last saved from (addCases responses=), in which case the case is
+        only marked as fetched, and parsing it again can be skipped.
+        """
+        content_hash = hashlib.sha256(content.encode()).hexdigest()
+        with self.conn:
+            stored = self.conn.execute(
+                "SELECT content_hash FROM raw_responses WHERE cnr_number = ? AND endpoint = ?", (cnr_number, endpoint)
             ).fetchone()
-            if search_result:
-                existing_row = json.loads(search_result[0])
-                patch = {}
-                for k in ['status', 'year', 'act_type', 'case_type']:
-                    patch[k] = extra_fields.get(k, existing_row.get(k))
-                d = json.dumps(case.json() | patch, default=str)
-                self.conn.execute("UPDATE cases SET value = ? WHERE json_extract(value, '$.cnr_number') = ?", (d, case.cnr_number))
-            else:
-                d = json.dumps(case.json() | extra_fields, default=str)
-                cursor.execute(
-                    "INSERT INTO cases VALUES (?, ?, ?)", (court.state_code, court.court_code or "1", d)
+            if not stored or stored[0] != content_hash:
+                return False
+            self.conn.execute(
+                "UPDATE raw_responses SET fetched_at = datetime('now') WHERE cnr_number = ? AND endpoint = ?",
+                (cnr_number, endpoint),
+            )
+            self.conn.execute("UPDATE cases SET fetched_at = datetime('now') WHERE cnr_number = ?", (cnr_number,))
+        self.skipped["parses"] += 1
+        return True
+
+    def getResponse(self, cnr_number: str, endpoint: str) -> Optional[str]:
+        r = self.conn.execute(
+            "SELECT body FROM raw_responses WHERE cnr_number = ? AND endpoint = ?", (cnr_number, endpoint)
+        ).fetchone()
+        return zlib.decompress(r[0]).decode() if r else None
+
+    def _content_hash(self, row: dict) -> str:
+        return hashlib.sha256(json.dumps(row, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _next_hearing_date(self, row: dict) -> Optional[str]:
+        dates = [h["next_date"] for h in row["hearings"] or [] if h.get("next_date")]
+        return str(max(dates)) if dates else None
+
+    def _case_value(self, row: dict) -> dict:
+        return {k: v for k, v in row.items() if k not in CASE_CHILD_FIELDS}
+
+    def _replace_children(self, rows: list[dict]):
+        cnrs = [(row["cnr_number"],) for row in rows]
+        for table in ["case_hearings", "case_orders", "case_parties"]:
+            self.conn.executemany(f"DELETE FROM {table} WHERE cnr_number = ?", cnrs)
+        for table, field in [("case_hearings", "hearings"), ("case_orders", "orders")]:
+            self.conn.executemany(
+                f"INSERT INTO {table} (cnr_number, idx, value) VALUES (?, ?, ?)",
+                (
+                    (row["cnr_number"], idx, json.dumps(item, default=str))
+                    for row in rows
+                    for idx, item in enumerate(row[field] or [])
+                ),
+            )
+        self.conn.executemany(
+            "INSERT INTO case_parties VALUES (?, ?, ?, ?, ?)",
+            (
+                (row["cnr_number"], role, idx, party["name"], party["advocate"])
+                for row in rows
+                for role, field in [("petitioner", "petitioners"), ("respondent", "respondents")]
+                for idx, party in enumerate(row[field] or [])
+            ),
+        )
+
+    def _index_cases(self, rows: list[dict]):
+        cnrs = [(row["cnr_number"],) for row in rows]
+        self.conn.executemany("DELETE FROM cases_fts WHERE rowid = (SELECT id FROM cases WHERE cnr_number = ?)", cnrs)
+        self.conn.executemany(
+            f"INSERT INTO cases_fts (rowid, title, parties, advocates, coram, category) {CASES_FTS_SQL} WHERE c.cnr_number = ?",
+            cnrs,
+        )
+
+    def search(self, query: str, limit: int = 20, raw: bool = False) -> list[dict]:
+        """
+        Full text search over case titles, party and advocate names,
+        coram and category, best matches first.
+
+        Every word in query must match, as a prefix. With raw=True, query
+        is passed on as is, in the FTS5 query syntax instead.
+        """
+        if not raw:
+            query = " ".join('"' + word.replace('"', '""') + '"*' for word in query.split())
+        if not query:
+            return []
+        r = self.conn.execute(
+            """
+            SELECT c.cnr_number, c.state_code, c.court_code, c.case_type, c.registration_number,
+                c.case_status, f.title, f.rank
+            FROM cases_fts f JOIN cases c ON c.id = f.rowid
+            WHERE cases_fts MATCH ? ORDER BY f.rank LIMIT ?
+            """,
+            (query, limit),
+        )
+        columns = [d[0] for d in r.description]
+        return [dict(zip(columns, row)) for row in r]
+
+    def _upsert_sql(self, extra_fields: dict, case_fields) -> str:
+        # The updated value is derived from the inserted one (excluded.value),
+        # so every case is only serialised once
+        update_value = "excluded.value"
+        dropped = [k for k in extra_fields if k not in self.CASE_PATCH_FIELDS]
+        if any(k in case_fields for k in dropped):
+            raise ValueError(f"extra_fields can not override case fields: {dropped}")
+        if dropped:
+            paths = ", ".join(f"'$.{k}'" for k in dropped)
+            update_value = f"json_remove({update_value}, {paths})"
+        for k in self.CASE_PATCH_FIELDS:
+            if k not in extra_fields:
+                update_value = f"json_set({update_value}, '$.{k}', json_extract(cases.value, '$.{k}'))"
+        return (
+            "INSERT INTO cases (state_code, court_code, value, content_hash, next_hearing_date, updated_at, fetched_at, updated_seq) "
+            "VALUES (?, ?, ?, ?, ?, datetime('now'), datetime('now'), (SELECT ifnull(max(updated_seq), 0) + 1 FROM cases)) "
+            "ON CONFLICT (cnr_number) "
+            f"DO UPDATE SET value = {update_value}, "
+            "updated_at = iif(cases.content_hash IS excluded.content_hash, cases.updated_at, excluded.updated_at), "
+            "updated_seq = iif(cases.content_hash IS excluded.content_hash, cases.updated_seq, excluded.updated_seq), "
+            "fetched_at = excluded.fetched_at, content_hash = excluded.content_hash, "
+            "next_hearing_date = excluded.next_hearing_date"
+        )
+
+    def getCases(
+        self,
+        cnr: Optional[str] = None,
+        court: Optional[Court] = None,
+        category: Optional[str] = None,
+        unexpanded: bool = False,
+        updated_before: Optional[datetime] = None,
+        stale_after: Optional[timedelta] = None,
+        sample: Optional[int] = None,
+        page_size: int = 1000,
+    ) -> Iterator[dict]:
+        """
+        Yields cases as dicts, with their hearings, orders and parties put
+        back in from the child tables. Cases come in insertion order, read
+        a page at a time, so writing cases while iterating is fine.
+
+        cnr, court, category: only cases matching these
+        unexpanded: only cases without a case_status, ie never enriched
+        updated_before: only cases last changed before this UTC datetime,
+            or never since updated_at was tracked
+        stale_after: only cases due for a refresh. These are unexpanded
+            cases, cases not fetched within stale_after, and cases whose
+            next hearing has passed since they were last fetched.
+        sample: a random sample of this many of the matching cases instead
+        """
+        where, params = [], []
+        if cnr:
+            where.append("c.cnr_number = ?")
+            params.append(cnr.replace("-", ""))
+        if court:
+            where.append("c.state_code = ? AND c.court_code = ?")
+            params += [court.state_code, court.court_code or "1"]
+        if category:
+            where.append("c.category = ?")
+            params.append(category)
+        if unexpanded:
+            where.append("c.case_status IS NULL")
+        if updated_before:
+            where.append("(c.updated_at IS NULL OR c.updated_at < ?)")
+            params.append(updated_before.strftime("%Y-%m-%d %H:%M:%S"))
+        if stale_after is not None:
+            where.append(
+                "(c.case_status IS NULL OR c.fetched_at IS NULL OR c.fetched_at < datetime('now', ?)"
+                " OR (c.next_hearing_date < date('now') AND date(c.fetched_at) <= c.next_hearing_date))"
+            )
+            params.append(f"-{int(stale_after.total_seconds())} seconds")
+
+        if sample:
+            # Only ids are sorted, and SQLite keeps just the top `sample` of them
+            ids = [
+                r[0] for r in self.conn.execute(
+                    f"SELECT c.id FROM cases c {self._where(where)} ORDER BY RANDOM() LIMIT ?",
+                    params + [sample],
                 )
-        cursor.close()
-        self.conn.commit()
+            ]
+            for i in range(0, len(ids), page_size):
+                page = ids[i:i + page_size]
+                rows = {
+                    r[0]: r for r in self.conn.execute(
+                        f"{self._cases_sql()} WHERE c.id IN ({','.join('?' * len(page))})", page
+                    )
+                }
+                for id in page:
+                    yield self._case_dict(rows[id])
+            return
 
-    def getCases(self):
-        for (state_code, court_code, value) in self.conn.execute("SELECT state_code, court_code, value FROM cases ORDER BY RANDOM()"):
-            yield json.loads(value) | {"state_code": state_code, "court_code": court_code}
+        last = 0
+        while True:
+            rows = self.conn.execute(
+                f"{self._cases_sql()} {self._where(where + ['c.id > ?'])} ORDER BY c.id LIMIT ?",
+                params + [last, page_size],
+            ).fetchall()
+            for row in rows:
+                yield self._case_dict(row)
+            if len(rows) < page_size:
+                return
+            last = rows[-1][0]
+
+    def _where(self, conditions: list[str]) -> str:
+        return ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    def _cases_sql(self) -> str:
+        return f"""
+            SELECT c.id, state_code, court_code, value,
+                (SELECT json_group_array(json(value)) FROM (SELECT value FROM case_hearings h WHERE h.cnr_number = c.cnr_number ORDER BY idx)),
+                (SELECT json_group_array(json(value)) FROM (SELECT value FROM case_orders o WHERE o.cnr_number = c.cnr_number ORDER BY idx)),
+                {self._parties_sql("petitioner")},
+                {self._parties_sql("respondent")}
+            FROM cases c
+        """
+
+    def _case_dict(self, row) -> dict:
+        _, state_code, court_code, value, *child_values = row
+        case = json.loads(value)
+        for field, child_value in zip(CASE_CHILD_FIELDS, child_values):
+            case[field] = json.loads(child_value)
+        return case | {"state_code": state_code, "court_code": court_code}
+
+    def _parties_sql(self, role: str) -> str:
+        return (
+            "(SELECT json_group_array(json_object('name', name, 'advocate', advocate)) FROM "
+            f"(SELECT name, advocate FROM case_parties p WHERE p.cnr_number = c.cnr_number AND role = '{role}' ORDER BY idx))"
+        )
 
 
     def stats(self) -> dict[str, int]:
         """
         Returns a dict of tableName -> count
         """
-        tables = ["case_types", "act_types", "courts", "cases"]
+        tables = ["case_types", "act_types", "courts", "cases", "case_hearings", "case_orders", "case_parties"]
         stats = {}
         for table in tables:
             stats[table] = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
         return stats
+
+
+class StorageWriter:
+    """
+    Funnels writes from any number of threads into a single connection,
+    owned by a background thread, so that scraping workers never contend
+    for the database lock. The database is opened in WAL mode, so other
+    processes can keep reading it meanwhile.
+
+    Writes are queued and return immediately. Queued addCases calls for
+    the same court and extra_fields are merged, and written in batches of
+    Storage.BATCH_SIZE per transaction. Errors are raised from the next
+    flush() or close().
+    """
+
+    def __init__(self, filename="ecourts.db"):
+        self.filename = filename
+        self.queue = queue.Queue()
+        self.errors = []
+        # Set if the database could not be opened, raised by every flush() and close()
+        self.failed = None
+        self.written = 0
+        self.thread = threading.Thread(target=self._run, name="StorageWriter", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def addCases(self, court: Court, cases: list[Case], extra_fields: dict = {}, responses: list[tuple[str, str, str]] = []):
+        self.queue.put(("addCases", court, list(cases), dict(extra_fields), list(responses)))
+
+    def addCaseTypes(self, records: list[CaseType]):
+        self.queue.put(("addCaseTypes", list(records)))
+
+    def addActTypes(self, records: list[ActType]):
+        self.queue.put(("addActTypes", list(records)))
+
+    def addCourts(self, records: list[Court]):
+        self.queue.put(("addCourts", list(records)))
+
+    def flush(self):
+        """
+        Block until everything queued so far is written
+        """
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.failed:
+            raise self.failed
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+
+    def _drain(self, item) -> list:
+        items = [item]
+        if item is None:
+            return items
+        size = len(item[2]) if item[0] == "addCases" else 0
+        while size < Storage.BATCH_SIZE:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            items.append(item)
+            if item is None:
+                break
+            if item[0] == "addCases":
+                size += len(item[2])
+        return items
+
+    def _merge(self, items: list) -> list:
+        merged = []
+        for item in items:
+            if item is None:
+                continue
+            last = merged[-1] if merged else None
+            if (
+                last and item[0] == last[0] == "addCases"
+                and item[1] == last[1] and item[3] == last[3]
+            ):
+                last[2].extend(item[2])
+                last[4].extend(item[4])
+            elif item[0] == "addCases":
+                merged.append((item[0], item[1], list(item[2]), item[3], list(item[4])))
+            else:
+                merged.append(item)
+        return merged
+
+    def _run(self):
+        storage = None
+        try:
+            storage = Storage(self.filename, wal=True)
+        except Exception as e:
+            # Keep consuming the queue, so flush() and close() return and
+            # raise this instead of blocking
+            self.failed = e
+        try:
+            while True:
+                items = self._drain(self.queue.get())
+                for method, *args in self._merge(items) if storage else []:
+                    try:
+                        getattr(storage, method)(*args)
+                        self.written += len(args[1] if method == "addCases" else args[0])
+                    except Exception as e:
+                        self.errors.append(e)
+                for _ in items:
+                    self.queue.task_done()
+                if items[-1] is None:
+                    return
+        finally:
+            if storage:
+                storage.close()
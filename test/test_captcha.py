@@ -1,6 +1,8 @@
 import pytest
 import glob
-from captcha import Captcha
+from captcha import Captcha, CaptchaError, CaptchaPool, CaptchaSolverPool, TesseractProcess, ocr_backend
+import numpy as np
+import cv2
 import os
 
 
@@ -12,3 +14,112 @@ def captcha_image(request):
 def test_captcha(captcha_image):
     filename = os.path.basename(captcha_image)
     assert Captcha().decaptcha(captcha_image) == filename[:-4]
+
+
+def test_ocr_backend():
+    assert isinstance(ocr_backend("subprocess"), TesseractProcess)
+    assert ocr_backend("subprocess") is ocr_backend("subprocess")
+    with pytest.raises(ValueError):
+        ocr_backend("nope")
+
+
+def test_parse_hocr():
+    hocr = (
+        "<span class='ocrx_word' id='word_1_1' title='bbox 4 8 158 44; x_wconf 91'>"
+        "<span class='ocrx_cinfo' title='x_bboxes 4 9 30 44; x_conf 99.4'>a</span>"
+        "<span class='ocrx_cinfo' title='x_bboxes 31 9 60 44; x_conf 62.5'>7</span>"
+        "</span>"
+    )
+    assert TesseractProcess().parse_hocr(hocr) == ("a7", [99.4, 62.5])
+    hocr = "<span class='ocrx_word' id='word_1_1' title='bbox 4 8 158 44; x_wconf 91'>ab</span>"
+    assert TesseractProcess().parse_hocr(hocr) == ("ab", [91.0, 91.0])
+
+
+def test_captcha_confidence():
+    confidences = iter([[99, 99, 40, 99, 99], [99, 95, 85, 99, 99], [99, 99, 99, 99, 99]])
+    captcha = Captcha(ocr=lambda img: ("abc12", next(confidences)), min_confidence=50)
+    _, png = cv2.imencode(".png", np.full((80, 215, 3), 255, dtype=np.uint8))
+    with pytest.raises(CaptchaError):
+        captcha.decode(png.tobytes())
+    captcha.report(captcha.decode(png.tobytes()), False)
+    captcha.report(captcha.decode(png.tobytes()), True)
+    stats = captcha.confidence_stats()
+    assert stats["low_confidence"] == 1
+    assert stats["reject_rate"] == 0.5
+    assert stats["buckets"] == {
+        80: {"accepted": 0, "rejected": 1, "reject_rate": 1.0},
+        90: {"accepted": 1, "rejected": 0, "reject_rate": 0.0},
+    }
+
+
+def test_captcha_ocr_gets_cropped_array():
+    seen = []
+
+    def ocr(img):
+        seen.append(img)
+        return ("abc12", [90.0] * 5) if len(seen) == 1 else ("abc", [90.0] * 3)
+
+    captcha = Captcha(ocr=ocr)
+    _, png = cv2.imencode(".png", np.full((80, 215, 3), 255, dtype=np.uint8))
+    assert captcha.decode(png.tobytes()) == "abc12"
+    with pytest.raises(CaptchaError):
+        captcha.decode(png.tobytes())
+    assert seen[0].shape == (50, 163)
+    assert seen[0].dtype == np.uint8
+
+
+class CountingCaptcha:
+    def __init__(self):
+        self.calls = 0
+
+    def solve(self):
+        self.calls += 1
+        return f"abc{self.calls:02}"
+
+
+def test_captcha_pool():
+    pool = CaptchaPool(CountingCaptcha(), ttl=60)
+    assert pool.solve() == "abc01"
+    pool.release()
+    assert pool.solve() == "abc02"
+    assert pool.stats() | {"waited": 0} == {
+        "size": 0, "hits": 1, "misses": 1, "stale": 0, "hit_rate": 0.5, "waited": 0
+    }
+
+    pool.ttl = -1
+    pool.release()
+    assert pool.solve() == "abc04"
+    assert pool.stale == 1
+    pool.close()
+
+
+def test_captcha_archive(tmp_path):
+    results = iter(["aaaaa", "xxxxx", "bbbbb", "ccccc"])
+    captcha = Captcha(ocr=lambda img: (next(results), [90.0] * 5), archive=str(tmp_path), archive_limit=2)
+    _, png = cv2.imencode(".png", np.full((80, 215, 3), 255, dtype=np.uint8))
+    # Only captchas the server accepted are kept
+    for accepted in [True, False, True, True]:
+        captcha.report(captcha.decode(png.tobytes()), accepted)
+    assert sorted(os.listdir(tmp_path)) == ["aaaaa.png", "bbbbb.png"]
+    assert (tmp_path / "aaaaa.png").read_bytes() == png.tobytes()
+
+
+def test_captcha_solver_pool():
+    with CaptchaSolverPool(workers=2, ocr="subprocess") as pool:
+        assert pool.solve_many([b"not", b"an", b"image"]) == [(None, None)] * 3
+        assert pool.submit(b"").result() == (None, None)
+
+
+def test_captcha_solver_pool_confidence(monkeypatch):
+    import captcha as module
+
+    confidences = iter([[99, 99, 40, 99, 99], [99, 95, 85, 99, 99]])
+    worker = Captcha(ocr=lambda img: ("abc12", next(confidences)), min_confidence=50)
+    monkeypatch.setattr(module, "_worker_captcha", worker)
+    _, png = cv2.imencode(".png", np.full((80, 215, 3), 255, dtype=np.uint8))
+    assert module._solve_in_worker(png.tobytes()) == (None, 40)
+    assert module._solve_in_worker(png.tobytes()) == ("abc12", 85)
+    # Solved in a worker, reported in the parent
+    parent = Captcha(ocr=lambda img: ("", []))
+    parent.report(parent.track("abc12", 85, png.tobytes()), False)
+    assert parent.confidence_stats()["buckets"] == {80: {"accepted": 0, "rejected": 1, "reject_rate": 1.0}}
@@ -2,8 +2,17 @@ import pytest
 from entities import Court, CaseType, Order, Case,Party
 from entities.hearing import UnexpandableHearing
 from ecourt import ECourt
+from csrf import CSRFToken
+from captcha import Captcha, CaptchaError
+from ratelimit import RateLimiter
+from sessions import SessionPool
+import http.server
+import threading
+from retry import Failure, RetryPolicy, SessionExpiredError
+import requests
 import os
 import datetime
+import asyncio
 import yaml
 
 
@@ -219,3 +228,332 @@ def test_case_expander():
     order = fcase2.orders[0]
     ecourt.downloadOrder(order, fcase2, "/tmp/GAHC010225502018-01.pdf")
     assert os.path.getsize("/tmp/GAHC010225502018-01.pdf") == 75073
+
+
+@pytest.mark.vcr("test_get_act_type.yaml")
+def test_async_get_act_type():
+    from async_ecourt import AsyncECourt
+    court = Court(state_code="3")
+
+    async def fetch():
+        async with AsyncECourt(court) as ecourt:
+            return list(await ecourt.getActTypes())
+
+    acts = asyncio.run(fetch())
+    assert len(acts) > 14
+    assert all(act.court == court for act in acts)
+    assert (acts[0].code, acts[0].description) == (172, 'Admirality (Jurisdiction and Settlement of Maritime Claims) Act')
+
+
+@pytest.mark.vcr("test_case_history.yaml")
+def test_async_case_history_and_cause_lists():
+    from async_ecourt import AsyncECourt, HostLimiter
+    limiter = HostLimiter(1)
+    case = Case(
+        case_type="CRL.P",
+        registration_number="5658/2024",
+        cnr_number="KAHC010337682024",
+        token="14b7927a52c474a5c85379fe180635c8957638b3440506b816c755af53b91990",
+        case_number="211200056582024",
+    )
+
+    async def fetch():
+        async with AsyncECourt(Court(state_code="3"), limiter=limiter) as ecourt:
+            return await asyncio.gather(
+                ecourt.getCauseLists(datetime.date(2034, 12, 31)),
+                ecourt.getCaseHistory(case),
+            )
+
+    cause_lists, history = asyncio.run(fetch())
+    assert list(cause_lists) == []
+    assert isinstance(history, str)
+
+
+def fake_response(status_code, body):
+    r = requests.Response()
+    r.status_code = status_code
+    r._content = body.encode()
+    r.encoding = "utf-8"
+    return r
+
+
+class CSRFSession:
+    """Rejects the seeded csrf token, and serves a fresh one"""
+    def __init__(self):
+        self.posts = []
+        self.gets = 0
+
+    def get(self, url, **kwargs):
+        self.gets += 1
+        return fake_response(200, """<script>var csrfMagicToken = "sid:fresh,1";</script>""")
+
+    def post(self, url, data, **kwargs):
+        self.posts.append(data["__csrf_magic"])
+        if data["__csrf_magic"] != "sid:fresh,1":
+            return fake_response(403, "<html><body>CSRF check failed. Your form session may have expired</body></html>")
+        return fake_response(200, "1~A - Appeal")
+
+
+def test_csrf_refresh():
+    ecourt = ECourt(Court(state_code="3"))
+    ecourt.session = ecourt.csrf.session = CSRFSession()
+    ecourt.set_max_attempts(1)
+    assert list(ecourt.getCaseTypes()) == []
+    assert ecourt.session.posts == [ECourt.CSRF_MAGIC_PARAMS["__csrf_magic"], "sid:fresh,1"]
+    assert ecourt.session.gets == 1
+    assert ecourt.csrf.params() == {"__csrf_magic": "sid:fresh,1"}
+
+
+def test_csrf_token_parse():
+    csrf = CSRFToken()
+    assert csrf.parse("""<input type='hidden' name='__csrf_magic' value="sid:abc,123" />""") == "sid:abc,123"
+    assert csrf.parse("<html></html>") is None
+
+
+class FlakySession(CSRFSession):
+    """Fails the first post at the transport level, then errors once with a 503"""
+    def post(self, url, data, **kwargs):
+        self.posts.append(data["captcha"])
+        if len(self.posts) == 1:
+            raise requests.exceptions.ConnectionError()
+        if len(self.posts) == 2:
+            return fake_response(503, "")
+        return fake_response(200, "")
+
+
+class CountingCaptcha(Captcha):
+    def __init__(self):
+        super().__init__(ocr=lambda img: ("", []))
+        self.calls = 0
+
+    def solve(self):
+        self.calls += 1
+        return f"abc{self.calls:02}"
+
+
+def test_retry_policy():
+    policy = RetryPolicy(base=1, cap=4, transport_delay=0)
+    assert policy.classify(CaptchaError()) == Failure.CAPTCHA
+    assert policy.classify(requests.exceptions.Timeout()) == Failure.TRANSPORT
+    assert policy.classify(requests.exceptions.HTTPError(response=fake_response(502, ""))) == Failure.SERVER
+    assert policy.classify(SessionExpiredError()) == Failure.SESSION_EXPIRED
+    assert policy.delay(Failure.CAPTCHA, 3) == 0
+    assert 0.5 <= policy.delay(Failure.SERVER, 1) <= 1
+    assert 2 <= policy.delay(Failure.SERVER, 5) <= 4
+
+    ecourt = ECourt(Court(state_code="3"))
+    ecourt.session = FlakySession()
+    ecourt.captcha = CountingCaptcha()
+    ecourt.set_retry_policy(RetryPolicy(base=0.01, transport_delay=0))
+    ecourt.getOrdersOnDate(datetime.date(2024, 6, 5))
+    # The captcha is reused after the transport error, and solved again after the 503
+    assert ecourt.session.posts == ["abc01", "abc01", "abc02"]
+    stats = ecourt.call_log[-1]
+    assert stats.path == "/cases/s_orderdate_qry.php"
+    assert stats.attempts == 3
+    assert stats.failures == {Failure.TRANSPORT: 1, Failure.SERVER: 1}
+    assert 0.005 <= stats.slept <= 0.01
+
+
+def test_async_retry_policy():
+    httpx = pytest.importorskip("httpx")
+    from urllib.parse import parse_qs
+    from async_ecourt import AsyncECourt
+
+    posts = []
+
+    def handler(request):
+        # The same failures as FlakySession
+        posts.append(parse_qs(request.content.decode())["captcha"][0])
+        if len(posts) == 1:
+            raise httpx.ConnectError("down")
+        if len(posts) == 2:
+            return httpx.Response(503)
+        return httpx.Response(200, text="")
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with AsyncECourt(Court(state_code="3"), client=client) as ecourt:
+            solved = iter(range(1, 10))
+
+            async def solve_captcha():
+                return f"abc{next(solved):02}"
+
+            ecourt.solve_captcha = solve_captcha
+            ecourt.set_retry_policy(RetryPolicy(base=0.01, transport_delay=0))
+            await ecourt.getOrdersOnDate(datetime.date(2024, 6, 5))
+            return ecourt.call_log[-1]
+
+    stats = asyncio.run(run())
+    assert posts == ["abc01", "abc01", "abc02"]
+    assert stats.attempts == 3
+    assert stats.failures == {Failure.TRANSPORT: 1, Failure.SERVER: 1}
+
+
+def test_redirect_check():
+    httpx = pytest.importorskip("httpx")
+    from ecourt import ApiCall
+
+    call = ApiCall(ECourt(Court(state_code="3")), "/cases/s_casetype_qry.php", False, False, None)
+    request = httpx.Request("POST", ECourt.BASE_URL)
+    # A plain redirect passes with both clients, an errormsg one fails with both
+    for location, error in [("o_civil_case_history.php", None), ("errormsg.php", ValueError)]:
+        redirect = fake_response(302, "")
+        redirect.headers["location"] = location
+        for response in [redirect, httpx.Response(302, headers={"location": location}, request=request)]:
+            if error:
+                with pytest.raises(error):
+                    call.check(response)
+            else:
+                call.check(response)
+
+def test_rate_limiter(tmp_path):
+    url = "https://hcservices.ecourts.gov.in/ecourtindiaHC/cases/s_casetype_qry.php"
+    limiter = RateLimiter()
+    assert limiter.reserve(url) == 0
+
+    limiter.set_rate(10, burst=2)
+    limiter.set_rate(1, path="/cases/s_casetype_qry.php")
+    assert limiter.reserve(url) == 0
+    assert limiter.reserve(url) == pytest.approx(1, abs=0.01)
+    other = "https://hcservices.ecourts.gov.in/ecourtindiaHC/cases/s_actwise_qry.php"
+    assert [limiter.reserve(other) for _ in range(3)] == [0, 0, pytest.approx(0.1, abs=0.01)]
+
+    # Two limiters on the same lock file share one bucket
+    a = RateLimiter(10, lockfile=str(tmp_path / "rate"))
+    b = RateLimiter(10, lockfile=str(tmp_path / "rate"))
+    assert a.reserve(url) == 0
+    assert b.reserve(url) == pytest.approx(0.1, abs=0.01)
+
+
+class KeepAliveHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        cookie = self.headers.get("Cookie")
+        body = (cookie or "").encode()
+        self.send_response(200)
+        if not cookie:
+            self.send_header("Set-Cookie", f"PHPSESSID={self.path.strip('/')}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_session_pool():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+    pool = SessionPool(pool_maxsize=2)
+    try:
+        a, b = pool.get(Court(state_code="3")), pool.get(Court(state_code="6"))
+        assert pool.get(Court(state_code="3", court_code="1")) is a
+        a.get(f"{url}/a")
+        b.get(f"{url}/b")
+        # Each court keeps its own server session
+        assert a.get(url).text == "PHPSESSID=a"
+        assert b.get(url).text == "PHPSESSID=b"
+        assert pool.stats() == {"sessions": 2, "requests": 4, "connections": 1, "reuse_ratio": 0.75}
+    finally:
+        pool.close()
+        server.shutdown()
+
+
+def test_expand_case_unchanged(tmp_path):
+    from storage import Storage
+
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    ecourt = ECourt(Court(state_code="3"))
+    ecourt.set_response_store(storage)
+    html = open("test/fixtures/case_details/KAHC010337682024.html").read()
+    ecourt.getCaseHistory = lambda case: html
+    case = Case(case_type="CRL.P", registration_number="1/2024", cnr_number="KAHC010337682024")
+
+    expanded = ecourt.expand_case(case)
+    assert expanded.cnr_number == "KAHC010337682024"
+    # The page is only recorded along with its case
+    assert storage.getResponse("KAHC010337682024", "/cases/o_civil_case_history.php") is None
+    assert ecourt.expand_case(case) is not None
+    storage.addCases(ecourt.court, [expanded], responses=ecourt.take_responses([expanded]))
+    assert storage.getResponse("KAHC010337682024", "/cases/o_civil_case_history.php") == html
+    assert ecourt.pending_responses == {}
+    # The same page again is not parsed
+    assert ecourt.expand_case(case) is None
+    assert storage.skipped["parses"] == 1
+    # A later search result overwrites the case, its page must be parsed again
+    search_case = Case(
+        case_type="CRL.P", registration_number="5658/2024", cnr_number="KAHC010337682024",
+        petitioners=[Party(name="ROHIT TIWARI")], respondents=[Party(name="STATE OF KARNATAKA")],
+    )
+    storage.addCases(ecourt.court, [search_case], {"status": "Pending"})
+    assert [c["cnr_number"] for c in storage.getCases(unexpanded=True)] == ["KAHC010337682024"]
+    assert storage.getResponse("KAHC010337682024", "/cases/o_civil_case_history.php") is None
+    assert ecourt.expand_case(case) is not None
+    html = html.replace("ROHIT TIWARI", "ROHIT TIWARY")
+    assert ecourt.expand_case(case).petitioners[0].name == "ROHIT TIWARY"
+    storage.close()
+
+
+def test_expand_case_parse_error(tmp_path):
+    from storage import Storage
+
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    ecourt = ECourt(Court(state_code="3"))
+    ecourt.set_response_store(storage)
+    html = "<html><body>Invalid Request</body></html>"
+    ecourt.getCaseHistory = lambda case: html
+    case = Case(case_type="CRL.P", registration_number="1/2024", cnr_number="KAHC010337682024")
+
+    with pytest.raises(ValueError):
+        ecourt.expand_case(case)
+    # A failed page is not remembered, the next fetch is parsed again
+    with pytest.raises(ValueError):
+        ecourt.expand_case(case)
+    html = open("test/fixtures/case_details/KAHC010337682024.html").read()
+    assert ecourt.expand_case(case).cnr_number == "KAHC010337682024"
+    assert storage.skipped["parses"] == 0
+    storage.close()
+
+
+@pytest.mark.vcr("test_case_history.yaml")
+def test_archive_reparse(tmp_path, monkeypatch):
+    pytest.importorskip("zstandard")
+    from archive import ResponseArchive, reparse
+    from storage import Storage
+
+    archive = ResponseArchive(str(tmp_path / "archive"))
+    monkeypatch.setattr(ECourt, "ARCHIVE", archive)
+    ecourt = ECourt(Court(state_code="3"))
+    html = ecourt.getCaseHistory(
+        case=Case(
+            case_type="CRL.P",
+            registration_number="5658/2024",
+            cnr_number="KAHC010337682024",
+            token="14b7927a52c474a5c85379fe180635c8957638b3440506b816c755af53b91990",
+            case_number="211200056582024",
+        )
+    )
+    (entry,) = archive.entries()
+    assert entry["path"] == "/cases/o_civil_case_history.php"
+    assert entry["params"]["cino"] == "KAHC010337682024"
+    assert "__csrf_magic" not in entry["params"]
+    assert archive.read(entry["digest"]) == html
+
+    # The recorded response is an error page, replay a real one instead
+    archive = ResponseArchive(str(tmp_path / "fixtures"))
+    archive.add(
+        "/cases/o_civil_case_history.php",
+        entry["params"],
+        Court(state_code="3"),
+        open("test/fixtures/case_details/KAHC010337682024.html").read(),
+    )
+    archive.add("/cases/s_actwise_qry.php", {"action_code": "fillActType"}, Court(state_code="3"), "")
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    assert reparse(archive, storage, workers=2) == {"cases": 1, "orders": 0, "cause_lists": 0, "errors": 0, "skipped": 1}
+    (case,) = storage.getCases()
+    assert case["cnr_number"] == "KAHC010337682024"
+    assert case["case_number"] == "211200056582024"
+    storage.close()
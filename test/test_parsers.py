@@ -71,6 +71,22 @@ def test_case_details_parser(case_details):
     # assert len(html) / len(case_details.html) > 2
 
 
+@pytest.mark.parametrize("backend", CaseDetails.BACKENDS)
+def test_case_details_backends(case_details, backend):
+    if backend != "html5lib":
+        pytest.importorskip(backend)
+    html, expected = case_details
+    assert CaseDetails(html, backend=backend).case == expected
+
+
+def test_case_details_without_html(case_details):
+    html, expected = case_details
+    parsed = CaseDetails(html, keep_html=False)
+    assert parsed.case == expected
+    with pytest.raises(ValueError):
+        parsed.html
+
+
 def test_cases_parser(case_row):
     for case_obj in parse_cases(case_row):
         # if file exists
@@ -107,3 +123,54 @@ def test_cause_lists_parser(cause_lists):
     else:
         assert data == expected
 
+
+
+def test_case_details_errors():
+    with pytest.raises(ValueError):
+        CaseDetails("<html><body>Invalid Request</body></html>")
+
+
+def test_parse_dir(tmp_path):
+    from parse_dir import parse_dir
+    from storage import Storage
+
+    pages = sorted(glob.glob("test/fixtures/case_details/*.html"))
+    for page in pages:
+        (tmp_path / os.path.basename(page)).write_text(open(page).read())
+    (tmp_path / "broken.html").write_text("<html><body>Invalid Request</body></html>")
+    # Another CNR with the same case number in the same court can't be saved
+    duplicate = open("test/fixtures/case_details/KAHC010337682024.html").read().replace("KAHC01-033768-2024", "KAHC01-033769-2024")
+    (tmp_path / "KAHC010337692024.html").write_text(duplicate)
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    storage.BATCH_SIZE = 2
+    stats = parse_dir(str(tmp_path), Court(state_code="3"), storage, workers=2)
+    assert stats["files"] == len(pages) + 2
+    assert stats["cases"] == len(pages)
+    assert stats["errors"] == 2
+    assert sum(w["files"] for w in stats["workers"].values()) == len(pages) + 2
+    cnrs = {os.path.splitext(os.path.basename(page))[0] for page in pages}
+    assert {case["cnr_number"] for case in storage.getCases()} == cnrs
+    storage.close()
+
+
+def test_parse_date():
+    from parsers.utils import parse_date
+
+    assert parse_date("20240625") == datetime.date(2024, 6, 25)
+    assert parse_date("5-6-2024") == datetime.date(2024, 6, 5)
+    assert parse_date("25th June 2024") == datetime.date(2024, 6, 25)
+    assert parse_date("31-02-2024") is None
+    assert parse_date("01-01-2060") is None
+    assert parse_date("") is None
+
+
+def test_parse_js_call():
+    from parsers.utils import parse_js_call
+
+    call = "viewBusiness('1','2','','211200056582024','3','D','2024-06-25','1434','1')"
+    expected = {"court_code": "1", "district_code": "2", "next_date": "", "case_number": "211200056582024",
+                "state_code": "3", "disposal_flag": "D", "business_date": "2024-06-25", "court_no": "1434", "srno": "1"}
+    assert parse_js_call(call, CaseDetails.VIEW_BUSINESS) == expected
+    assert parse_js_call(call, CaseDetails.VIEW_BUSINESS) == expected
+    with pytest.raises(ValueError):
+        parse_js_call("viewBusiness('1')", CaseDetails.VIEW_BUSINESS)
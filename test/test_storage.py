@@ -1,7 +1,7 @@
 import pytest
 import os
-from storage import Storage
-from entities import Court, CaseType
+from storage import Storage, SCHEMA_VERSION
+from entities import Court, CaseType, Party
 import sqlite3
 import csv
 import glob
@@ -20,11 +20,11 @@ def test_storage_init():
     tables = storage.conn.execute(
         "SELECT name FROM sqlite_master WHERE type='table';"
     ).fetchall()
-    assert len(tables) == 4
-    assert "case_types" in tables[0]
-    assert "act_types" in tables[1]
-    assert "courts" in tables[2]
-    assert "cases" in tables[3]
+    # Leaving out the FTS5 shadow tables
+    assert {t[0] for t in tables if not t[0].startswith("cases_fts_")} == {
+        "case_types", "act_types", "courts", "cases", "case_hearings", "case_orders", "case_parties", "cases_fts", "raw_responses"
+    }
+    assert storage.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
 
     storage.close()
     os.unlink("/tmp/ecourts.db")
@@ -102,6 +102,17 @@ def test_case_types():
         description="APPCP - Application in Cr. Cont. Petn.",
         court=Court(state_code="1"),
     )
+    assert storage.findCaseType(Court(state_code="1", court_code="1"), "APPCP - Application in Cr. Cont. Petn.").code == 326
+    # Case types are scoped to their court
+    storage.addCaseTypes([CaseType(code=7, description="APPCP - Other", court=Court(state_code="1", court_code="2"))])
+    assert storage.findCaseType(Court(state_code="1", court_code="2"), "APPCP").code == 7
+    assert storage.findCaseType(Court(state_code="1"), "APPCP").code == 326
+    assert storage.findCaseType(Court(state_code="1", court_code="2"), "ABA") is None
+    plan = storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT value FROM case_types WHERE json_extract(value, '$.court_state_code') = ? AND ifnull(json_extract(value, '$.court_court_code'), '1') = ?",
+        ("1", "1"),
+    ).fetchall()
+    assert "USING INDEX idx_case_types_court" in plan[0][3]
     storage.close()
     os.unlink("/tmp/ecourts-case_types.db")
 
@@ -119,3 +130,333 @@ def test_case_storage(case_details):
     storage.close()
     os.unlink("/tmp/ecourts.db")
 
+
+
+def test_case_upsert(case_details):
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    storage = Storage("/tmp/ecourts.db")
+    court = Court(state_code="1")
+    storage.addCases(court, [case_details], {"status": "Pending", "year": 2024, "case_type_int": 7})
+    storage.addCases(court, [case_details], {"act_type": "101"})
+    records = storage.conn.execute("SELECT value FROM cases").fetchall()
+    assert len(records) == 1
+    data = json.loads(records[0][0])
+    # Patched fields keep their stored value unless given again
+    assert data["status"] == "Pending"
+    assert data["year"] == 2024
+    assert data["act_type"] == "101"
+    assert data["case_type"] == case_details.case_type
+    assert "case_type_int" not in data
+    assert data["cnr_number"] == case_details.cnr_number
+    storage.close()
+    os.unlink("/tmp/ecourts.db")
+
+
+def test_case_duplicates(case_details):
+    import copy
+
+    storage = Storage(":memory:")
+    court = Court(state_code="1")
+    later = copy.copy(case_details)
+    later.case_status = "DISPOSED"
+    later.hearings = case_details.hearings[:1]
+    storage.addCases(court, [case_details, later])
+    (data,) = storage.getCases()
+    assert data["case_status"] == "DISPOSED"
+    assert len(data["hearings"]) == 1
+    assert storage.search(case_details.petitioners[0].name.split()[0])[0]["cnr_number"] == case_details.cnr_number
+    storage.close()
+
+
+def test_case_roundtrip(case_details):
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    storage = Storage("/tmp/ecourts.db")
+    storage.addCases(Court(state_code="1"), [case_details])
+    # Hearings, orders and parties live in their own tables
+    value = json.loads(storage.conn.execute("SELECT value FROM cases").fetchone()[0])
+    assert "hearings" not in value
+    (data,) = storage.getCases()
+    expected = json.loads(json.dumps(case_details.json(), default=str))
+    assert data == expected | {"state_code": "1", "court_code": "1"}
+    storage.close()
+    os.unlink("/tmp/ecourts.db")
+
+
+def test_migration(case_details):
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    # A database written by the original, unversioned schema
+    conn = sqlite3.connect("/tmp/ecourts.db")
+    conn.execute("CREATE TABLE cases (state_code, court_code, value JSON)")
+    conn.execute("CREATE UNIQUE INDEX idx_cases_cnr ON cases(json_extract(value, '$.cnr_number'))")
+    conn.execute(
+        "INSERT INTO cases VALUES (?, ?, ?)",
+        ("1", "1", json.dumps(case_details.json() | {"status": "Pending"}, default=str)),
+    )
+    conn.commit()
+    conn.close()
+
+    storage = Storage("/tmp/ecourts.db")
+    assert storage.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    (data,) = storage.getCases()
+    expected = json.loads(json.dumps(case_details.json(), default=str))
+    assert data == expected | {"status": "Pending", "state_code": "1", "court_code": "1"}
+    assert storage.conn.execute("SELECT cnr_number, case_status FROM cases").fetchone() == (
+        case_details.cnr_number, case_details.case_status
+    )
+    plan = storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT value FROM cases WHERE category = ? AND case_status IS NULL", ("x",)
+    ).fetchall()
+    assert "USING INDEX idx_cases_category" in plan[0][3]
+    # Cases migrated from before the search index are in it
+    name = case_details.petitioners[0].name.split()[0]
+    assert [r["cnr_number"] for r in storage.search(name)] == [case_details.cnr_number]
+    storage.close()
+    os.unlink("/tmp/ecourts.db")
+
+
+def test_open_while_writing(tmp_path, monkeypatch):
+    Storage(str(tmp_path / "ecourts.db")).close()
+    writer = sqlite3.connect(str(tmp_path / "ecourts.db"))
+    writer.execute("BEGIN IMMEDIATE")
+    # An up to date database opens without waiting for the write lock
+    monkeypatch.setattr(Storage, "BUSY_TIMEOUT", 0.1)
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    assert storage.conn.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    storage.close()
+    writer.rollback()
+    writer.close()
+
+
+def test_wal_writer():
+    import copy
+    import threading
+    from storage import StorageWriter
+
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.exists("/tmp/ecourts-wal.db" + suffix):
+            os.unlink("/tmp/ecourts-wal.db" + suffix)
+    court = Court(state_code="1")
+    case_details = yaml.unsafe_load(open("test/fixtures/case_details/KAHC010337682024.yml"))
+    cases = []
+    for i in range(40):
+        case = copy.copy(case_details)
+        case.cnr_number = f"TEST{i:08d}2024"
+        case.registration_number = f"{i}/2024"
+        cases.append(case)
+
+    with StorageWriter("/tmp/ecourts-wal.db") as writer:
+        threads = [
+            threading.Thread(target=lambda chunk: [writer.addCases(court, [c]) for c in chunk], args=(cases[i::4],))
+            for i in range(4)
+        ]
+        for t in threads:
+            t.start()
+        # A reader in WAL mode is never blocked by the writer
+        reader = Storage("/tmp/ecourts-wal.db", wal=True)
+        reader.stats()
+        for t in threads:
+            t.join()
+        writer.flush()
+        assert reader.stats()["cases"] == 40
+    assert writer.written == 40
+    assert reader.conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    reader.close()
+    os.unlink("/tmp/ecourts-wal.db")
+
+
+def test_wal_writer_errors(case_details):
+    import queue
+    from storage import StorageWriter
+
+    # Opening the database fails, writes are not left waiting
+    writer = StorageWriter("/nonexistent/dir/ecourts.db")
+    writer.addCases(Court(state_code="1"), [case_details])
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    with pytest.raises(sqlite3.OperationalError):
+        writer.close()
+
+    # Batches are sized by the number of cases queued, not their extra_fields
+    writer = StorageWriter.__new__(StorageWriter)
+    writer.queue = queue.Queue()
+    writer.queue.put(("addCourts", [Court(state_code="1")]))
+    assert len(writer._drain(("addCases", Court(state_code="1"), [case_details] * Storage.BATCH_SIZE, {}, []))) == 1
+
+
+def test_get_cases_filters():
+    import copy
+    import datetime
+
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    storage = Storage("/tmp/ecourts.db")
+    template = yaml.unsafe_load(open("test/fixtures/case_details/KAHC010337682024.yml"))
+    cases = []
+    for i in range(10):
+        case = copy.copy(template)
+        case.cnr_number = f"TEST{i:08d}2024"
+        case.registration_number = f"{i}/2024"
+        case.category = "WRIT" if i % 2 else "BAIL"
+        case.case_status = None if i < 4 else "Disposed"
+        cases.append(case)
+    storage.addCases(Court(state_code="1"), cases[:5])
+    storage.addCases(Court(state_code="2"), cases[5:])
+
+    cnrs = lambda **kwargs: [c["cnr_number"] for c in storage.getCases(**kwargs)]
+    # Insertion order, read in pages
+    assert cnrs(page_size=3) == [c.cnr_number for c in cases]
+    assert cnrs(cnr="TEST-00000003-2024") == ["TEST000000032024"]
+    assert cnrs(unexpanded=True) == [c.cnr_number for c in cases[:4]]
+    assert cnrs(court=Court(state_code="2"), category="WRIT") == [cases[i].cnr_number for i in (5, 7, 9)]
+    assert cnrs(updated_before=datetime.datetime(2000, 1, 1)) == []
+    assert len(cnrs(updated_before=datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=1))) == 10
+    sample = cnrs(sample=4, page_size=3)
+    assert len(set(sample)) == 4 and set(sample) <= {c.cnr_number for c in cases}
+
+    plan = storage.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT id FROM cases c WHERE c.case_status IS NULL AND c.id > ? ORDER BY c.id", (0,)
+    ).fetchall()
+    assert "USING INDEX idx_cases_status" in plan[0][3]
+    storage.close()
+    os.unlink("/tmp/ecourts.db")
+
+
+def test_search():
+    import copy
+
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    storage = Storage("/tmp/ecourts.db")
+    case = yaml.unsafe_load(open("test/fixtures/case_details/KAHC010337682024.yml"))
+    other = copy.copy(case)
+    other.cnr_number = "TEST000000012024"
+    other.registration_number = "1/2024"
+    other.petitioners = other.petitioners[1:]
+    storage.addCases(Court(state_code="3"), [case, other])
+
+    results = storage.search("rohit tiw")
+    assert [r["cnr_number"] for r in results] == [case.cnr_number]
+    assert results[0]["title"] == "ROHIT TIWARI vs STATE OF KARNATAKA"
+    assert len(storage.search("dhanush")) == 1
+    assert len(storage.search("karnataka")) == 2
+    assert storage.search("") == []
+
+    # Re-adding a case replaces its entry in the index
+    case.petitioners = case.petitioners[1:]
+    storage.addCases(Court(state_code="3"), [case])
+    assert storage.search("rohit") == []
+    assert storage.conn.execute("SELECT COUNT(*) FROM cases_fts").fetchone()[0] == 2
+
+    # Case ids, and so search results, survive a VACUUM after deletes
+    third = copy.copy(other)
+    third.cnr_number = "TEST000000022024"
+    third.registration_number = "2/2024"
+    third.petitioners = [Party(name="MEENA KUMARI")]
+    storage.addCases(Court(state_code="3"), [third])
+    storage.conn.execute("DELETE FROM cases_fts WHERE rowid = (SELECT id FROM cases WHERE cnr_number = ?)", (case.cnr_number,))
+    storage.conn.execute("DELETE FROM cases WHERE cnr_number = ?", (case.cnr_number,))
+    storage.conn.commit()
+    storage.conn.execute("VACUUM")
+    assert [r["cnr_number"] for r in storage.search("meena")] == [third.cnr_number]
+    storage.close()
+    os.unlink("/tmp/ecourts.db")
+
+
+def test_export_parquet(tmp_path):
+    import copy
+    pq = pytest.importorskip("pyarrow.parquet")
+    from export import export_parquet
+
+    storage = Storage(str(tmp_path / "ecourts.db"))
+    case = yaml.unsafe_load(open("test/fixtures/case_details/KAHC010337682024.yml"))
+    other = copy.copy(case)
+    other.cnr_number = "TEST000000012023"
+    other.registration_number = "1/2023"
+    storage.addCases(Court(state_code="3"), [case, other])
+
+    out = tmp_path / "export"
+    assert export_parquet(storage, str(out), chunk_size=1) == {"cases": 2, "hearings": 6, "orders": 0, "parties": 8}
+    cases = pq.read_table(out / "cases").to_pylist()
+    assert sorted(c["cnr_number"] for c in cases) == sorted([case.cnr_number, other.cnr_number])
+    assert {(str(c["state_code"]), str(c["court_code"]), str(c["year"])) for c in cases} == {("3", "1", "2024"), ("3", "1", "2023")}
+    hearings = pq.read_table(out / "hearings").to_pylist()
+    assert sorted(h["idx"] for h in hearings if h["cnr_number"] == case.cnr_number) == [0, 1, 2]
+
+    # Only cases changed since the last export are written again
+    storage.conn.execute("UPDATE cases SET updated_at = '2000-01-01 00:00:00'")
+    storage.conn.commit()
+    other.case_status = "Disposed"
+    storage.addCases(Court(state_code="3"), [other])
+    assert export_parquet(storage, str(out)) == {"cases": 1, "hearings": 3, "orders": 0, "parties": 4}
+    # Nothing changed since
+    assert export_parquet(storage, str(out)) == {"cases": 0, "hearings": 0, "orders": 0, "parties": 0}
+    assert export_parquet(storage, str(out)) == {"cases": 0, "hearings": 0, "orders": 0, "parties": 0}
+    # Child rows carry their case's updated_seq, to keep only the latest ones
+    hearings = pq.read_table(out / "hearings").to_pylist()
+    updated_seq = max(h["updated_seq"] for h in hearings if h["cnr_number"] == other.cnr_number)
+    assert sorted(h["idx"] for h in hearings if h["cnr_number"] == other.cnr_number and h["updated_seq"] == updated_seq) == [0, 1, 2]
+    assert all(h["updated_at"] != "2000-01-01 00:00:00" for h in hearings if h["updated_seq"] == updated_seq)
+    # Runs in the same second don't overwrite each other's files
+    files = len(list((out / "cases").rglob("*.parquet")))
+    assert export_parquet(storage, str(out), incremental=False)["cases"] == 2
+    assert export_parquet(storage, str(out), incremental=False)["cases"] == 2
+    assert len(list((out / "cases").rglob("*.parquet"))) == files + 4
+    storage.close()
+
+
+def test_refresh_schedule():
+    import copy
+    import datetime
+
+    if os.path.exists("/tmp/ecourts.db"):
+        os.unlink("/tmp/ecourts.db")
+    storage = Storage("/tmp/ecourts.db")
+    template = yaml.unsafe_load(open("test/fixtures/case_details/KAHC010337682024.yml"))
+    cases = []
+    for i in range(4):
+        case = copy.copy(template)
+        case.cnr_number = f"TEST{i:08d}2024"
+        case.registration_number = f"{i}/2024"
+        case.case_status = "Pending"
+        cases.append(case)
+    cases[0].case_status = None
+    storage.addCases(Court(state_code="3"), cases)
+    next_date = max(h.next_date for h in template.hearings if h.next_date)
+    assert storage.conn.execute("SELECT DISTINCT next_hearing_date FROM cases").fetchall() == [(str(next_date),)]
+
+    def set_case(i, fetched_at, next_hearing_date):
+        storage.conn.execute(
+            "UPDATE cases SET fetched_at = ?, next_hearing_date = ? WHERE cnr_number = ?",
+            (fetched_at, next_hearing_date, cases[i].cnr_number),
+        )
+        storage.conn.commit()
+
+    today = datetime.date.today()
+    recent = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    # Fetched recently, next hearing in the future
+    set_case(1, recent, str(today + datetime.timedelta(days=5)))
+    # Fetched a week ago
+    set_case(2, str(today - datetime.timedelta(days=7)) + " 10:00:00", str(today + datetime.timedelta(days=5)))
+    # Next hearing has passed since it was last fetched
+    set_case(3, str(today - datetime.timedelta(days=3)) + " 10:00:00", str(today - datetime.timedelta(days=1)))
+
+    due = [c["cnr_number"] for c in storage.getCases(stale_after=datetime.timedelta(days=30))]
+    assert due == [cases[0].cnr_number, cases[3].cnr_number]
+    due = [c["cnr_number"] for c in storage.getCases(stale_after=datetime.timedelta(days=2))]
+    assert due == [cases[0].cnr_number, cases[2].cnr_number, cases[3].cnr_number]
+
+    # Refetching an unchanged case only moves fetched_at
+    storage.conn.execute("UPDATE cases SET updated_at = '2000-01-01 00:00:00'")
+    storage.conn.commit()
+    storage.addCases(Court(state_code="3"), cases[1:3])
+    cases[2].case_status = "Disposed"
+    storage.addCases(Court(state_code="3"), cases[2:3])
+    updated = storage.conn.execute("SELECT cnr_number FROM cases WHERE updated_at > '2000-01-01 00:00:00'").fetchall()
+    assert updated == [(cases[2].cnr_number,)]
+    assert storage.skipped["writes"] == 2
+    assert [c["cnr_number"] for c in storage.getCases(stale_after=datetime.timedelta(days=2))] == [cases[0].cnr_number, cases[3].cnr_number]
+    storage.close()
+    os.unlink("/tmp/ecourts.db")